@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Compares the date helpers in dropboxwsgi.dates against the
+strptime()/strftime() based versions they replaced, and checks that
+both give the same results.
+
+Usage: python benchmarks/date_parsing.py [--count=N] [--distinct=N] [--runs=N]
+
+`distinct` controls how many different dates are used: a few (like a
+folder whose files were all added at once) mostly hit the memo, more
+than dropboxwsgi.dates.MEMO_SIZE mostly exercise the parsers.
+"""
+
+import calendar
+import getopt
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dropboxwsgi import dates
+
+def old_tz_offset(tz_string):
+    factor = 1 if tz_string[0] == '+' else -1
+    hours = 3600 * int(tz_string[1:3])
+    minutes = 60 * int(tz_string[3:5])
+    return factor * (hours + minutes)
+
+def old_dropbox_date_to_posix(date_string):
+    fmt_date, tz = date_string.rsplit(' ', 1)
+    ts = calendar.timegm(time.strptime(fmt_date, "%a, %d %b %Y %H:%M:%S"))
+    return ts + old_tz_offset(tz)
+
+def old_posix_to_http_date(ts=None):
+    if ts is None:
+        ts = time.time()
+    HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+    return time.strftime(HTTP_DATE_FORMAT, time.gmtime(ts))
+
+def old_posix_to_listing_date(ts):
+    return time.strftime("%Y-%b-%d %H:%M:%S", time.gmtime(ts))
+
+def old_http_date_to_posix(date_string):
+    for fmt in ["%a, %d %b %Y %H:%M:%S GMT",
+                "%A, %d-%b-%y %H:%M:%S GMT",
+                "%a %b %d %H:%M:%S %Y"]:
+        try:
+            _tt = time.strptime(date_string, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(_tt)
+    else:
+        raise ValueError("Date could not be parsed")
+
+def make_timestamps(distinct):
+    rand = random.Random(0)
+    return [rand.randint(0, 2 ** 31 - 1) for _ in range(distinct)]
+
+def dropbox_date(ts):
+    return time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(ts))
+
+def check(timestamps):
+    for ts in timestamps:
+        dd = dropbox_date(ts)
+        hd = old_posix_to_http_date(ts)
+        assert dates.dropbox_date_to_posix(dd) == old_dropbox_date_to_posix(dd) == ts, dd
+        assert dates.posix_to_http_date(ts) == hd, ts
+        assert dates.posix_to_listing_date(ts) == old_posix_to_listing_date(ts), ts
+        assert dates.http_date_to_posix(hd) == old_http_date_to_posix(hd) == ts, hd
+
+def bench(fn, args, count, runs):
+    n = len(args)
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        for i in range(count):
+            fn(args[i % n])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(argv):
+    opts, _ = getopt.getopt(argv[1:], '', ['count=', 'distinct=', 'runs='])
+    opts = dict(opts)
+    count = int(opts.get('--count', 100000))
+    distinct = int(opts.get('--distinct', 100))
+    runs = int(opts.get('--runs', 3))
+
+    # strptime() imports _strptime lazily, get that out of the way
+    time.strptime("2000", "%Y")
+
+    timestamps = make_timestamps(distinct)
+    check(timestamps)
+
+    dropbox_dates = [dropbox_date(ts) for ts in timestamps]
+    http_dates = [old_posix_to_http_date(ts) for ts in timestamps]
+
+    for (name, old, new, args) in [
+        ('dropbox_date_to_posix', old_dropbox_date_to_posix,
+         dates.dropbox_date_to_posix, dropbox_dates),
+        ('http_date_to_posix', old_http_date_to_posix,
+         dates.http_date_to_posix, http_dates),
+        ('posix_to_http_date', old_posix_to_http_date,
+         dates.posix_to_http_date, timestamps),
+        ('posix_to_listing_date', old_posix_to_listing_date,
+         dates.posix_to_listing_date, timestamps),
+        ]:
+        old_elapsed = bench(old, args, count, runs)
+        new_elapsed = bench(new, args, count, runs)
+        sys.stdout.write("%-22s old %8.2f us/call  new %8.2f us/call  speedup %6.1fx\n" %
+                         (name, old_elapsed * 1e6 / count, new_elapsed * 1e6 / count,
+                          old_elapsed / new_elapsed))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Micro-benchmarks for the per-request hot path: the conditional request
+logic, path decoding, directory listing rendering and the local cache.
+
+Usage: python benchmarks/hot_path.py [--runs=N] [--min-time=SECONDS]
+                                     [--filter=SUBSTRING] [--json=FILE]
+                                     [--compare=FILE] [--tolerance=FRACTION]
+
+Every benchmark is repeated until a run takes at least `min-time`
+seconds, the best of `runs` runs is reported. `json` writes the results
+("-" for stdout) so they can be kept around and passed to `compare` on
+a later version, which then exits with status 1 if anything got more
+than `tolerance` (default 0.25) slower.
+"""
+
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dropboxwsgi import dropboxwsgi as dw
+from dropboxwsgi.caching import FileSystemCache
+from dropboxwsgi._version import __version__
+
+def native(data):
+    # PATH_INFO as the server would hand it to us
+    if sys.version_info >= (3,):
+        return data.decode('latin1')
+    return data
+
+def cache_logic_benchmarks():
+    etag = '"_3a6b0c1f"'
+    modified = 1356998400
+    others = ['"_%08x"' % i for i in range(4)]
+    for (name, args) in [
+        ('unconditional', (etag, modified, None, None, None)),
+        ('if_none_match_hit', (etag, modified, None, [etag], None)),
+        ('if_none_match_miss', (etag, modified, None, others, None)),
+        ('if_modified_since', (etag, modified, None, None, modified + 60)),
+        ('if_match_failed', (etag, modified, others, None, None)),
+        ]:
+        def bench(args=args):
+            dw.http_cache_logic(*args)
+        yield ('http_cache_logic/' + name, bench)
+
+def get_match_benchmarks():
+    for (name, environ) in [
+        ('absent', {}),
+        ('any', {'HTTP_IF_NONE_MATCH': '*'}),
+        ('single', {'HTTP_IF_NONE_MATCH': '"_3a6b0c1f"'}),
+        ('single_variant', {'HTTP_IF_NONE_MATCH': '"_3a6b0c1f-gzip"'}),
+        ('list_of_8', {'HTTP_IF_NONE_MATCH': ', '.join('"_%08x"' % i for i in range(8))}),
+        ]:
+        def bench(environ=environ):
+            dw.get_match(environ, 'HTTP_IF_NONE_MATCH')
+        yield ('get_match/' + name, bench)
+
+def decode_path_benchmarks():
+    for (name, path) in [
+        ('ascii', native(b'/photos/2013/holiday/IMG_0001.jpg')),
+        ('utf8', native(u'/photos/2013/caf\xe9/\u5199\u771f.jpg'.encode('utf8'))),
+        ('latin1', native(u'/photos/2013/caf\xe9/IMG_0001.jpg'.encode('latin1'))),
+        ]:
+        def bench(path=path):
+            dw.decode_path(path)
+        yield ('decode_path/' + name, bench)
+
+def make_folder(n):
+    rand = random.Random(n)
+    contents = []
+    for i in range(n):
+        is_dir = rand.random() < 0.1
+        modified = time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+                                 time.gmtime(rand.randint(0, 2 ** 31 - 1)))
+        entry = dict(path=u'/folder/entry-%06d%s' % (i, u'' if is_dir else u'.txt'),
+                     is_dir=is_dir, modified=modified, size=u'%d KB' % rand.randint(1, 999))
+        if not is_dir:
+            entry['mime_type'] = u'text/plain'
+        contents.append(entry)
+    return dict(path=u'/folder', is_dir=True, hash=u'%x' % n, contents=contents)
+
+def listing_benchmarks():
+    environ = {'SERVER_SOFTWARE': 'bench'}
+    for n in (10, 1000, 10000):
+        md = make_folder(n)
+        def bench(md=md):
+            b''.join(dw._render_directory_contents(environ, md))
+        yield ('render_directory_contents/%d' % n, bench)
+
+def cache_benchmarks(cache):
+    for (name, path, etag) in [
+        ('file', native(b'/a/b/c/d/e/f/g/h/index.html'), '"_3a6b0c1f"'),
+        ('listing', native(b'/a/b/c/d/e/f/g/h/'), '"d4a6044bd46951ce8ef174fe47c389a47"'),
+        ]:
+        def bench(path=path, etag=etag):
+            cache._blob_path(cache._blob_key(path, etag))
+        yield ('blob_path/' + name, bench)
+
+    data = os.urandom(4096)
+    def headers(etag):
+        return [('Content-Type', 'text/html'),
+                ('Content-Length', str(len(data))),
+                ('ETag', etag),
+                ('Last-Modified', 'Tue, 01 Jan 2013 00:00:00 GMT')]
+
+    path = native(b'/site/index.html')
+    etags = ['"_%08x"' % i for i in range(2)]
+    def write(etag):
+        f = cache.write_cached_data(path, headers(etag))
+        try:
+            f.write(data)
+            f.done()
+        finally:
+            f.close()
+    write(etags[0])
+
+    def read_headers():
+        cache.read_cached_headers(path)
+    yield ('cache/read_cached_headers', read_headers)
+
+    def read_data():
+        cache.read_cached_headers(path)
+        f = cache.read_cached_data(path)
+        try:
+            f.read()
+        finally:
+            f.close()
+    yield ('cache/read_cached_data', read_data)
+
+    # alternate between two versions, so every write replaces the
+    # blob and garbage collects the old one like a changed file would
+    counter = [0]
+    def write_data():
+        counter[0] += 1
+        write(etags[counter[0] % 2])
+    yield ('cache/write_cached_data', write_data)
+
+    def round_trip():
+        counter[0] += 1
+        write(etags[counter[0] % 2])
+        read_data()
+    yield ('cache/round_trip', round_trip)
+
+def measure(fn, runs, min_time):
+    # find a number of calls that takes long enough to time reliably
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed * 1.2)))
+
+    best = elapsed
+    for _ in range(runs - 1):
+        start = time.time()
+        for _ in range(number):
+            fn()
+        best = min(best, time.time() - start)
+    return best / number, number
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = result['us_per_call'] / old['us_per_call']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        sys.stdout.write("%-40s %10.2f -> %10.2f us/call  %5.2fx%s\n" %
+                         (name, old['us_per_call'], result['us_per_call'], ratio, flag))
+    return regressions
+
+def main(argv):
+    opts, _ = getopt.getopt(argv[1:], '', ['runs=', 'min-time=', 'filter=', 'json=',
+                                           'compare=', 'tolerance='])
+    opts = dict(opts)
+    runs = int(opts.get('--runs', 5))
+    min_time = float(opts.get('--min-time', 0.2))
+    filter_ = opts.get('--filter', '')
+    tolerance = float(opts.get('--tolerance', 0.25))
+    # keep stdout clean for the JSON if that's where it's going
+    out = sys.stderr if opts.get('--json') == '-' else sys.stdout
+
+    # strptime() imports _strptime lazily, get that out of the way
+    time.strptime("2000", "%Y")
+
+    cache_dir = tempfile.mkdtemp(prefix='dropboxwsgi-bench-')
+    try:
+        cache = FileSystemCache(cache_dir)
+        benchmarks = [cache_logic_benchmarks(), get_match_benchmarks(),
+                      decode_path_benchmarks(), listing_benchmarks(),
+                      cache_benchmarks(cache)]
+
+        results = {}
+        for group in benchmarks:
+            for (name, fn) in group:
+                if filter_ not in name:
+                    continue
+                per_call, number = measure(fn, runs, min_time)
+                results[name] = dict(us_per_call=per_call * 1e6, calls=number)
+                if '--compare' not in opts:
+                    out.write("%-40s %10.2f us/call\n" % (name, per_call * 1e6))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    if '--json' in opts:
+        report = dict(version=__version__,
+                      python=platform.python_version(),
+                      implementation=platform.python_implementation(),
+                      platform=platform.platform(),
+                      time=int(time.time()),
+                      runs=runs,
+                      results=results)
+        if opts['--json'] == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            with open(opts['--json'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if '--compare' in opts:
+        with open(opts['--compare']) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, tolerance):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
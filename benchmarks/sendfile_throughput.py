@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compares the throughput of serving a cached file through the wsgiref
+server with and without the sendfile() fast path in dropboxwsgi.main.
+
+Usage: python benchmarks/sendfile_throughput.py [--size=MIB] [--runs=N]
+"""
+
+import getopt
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dropboxwsgi import main as dwmain
+
+MIB = 1024 * 1024
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *n):
+        pass
+
+class QuietSendfileRequestHandler(dwmain.SendfileRequestHandler):
+    def log_message(self, *n):
+        pass
+
+def make_file_app(path):
+    size = os.path.getsize(path)
+    def app(environ, start_response):
+        # same as a cache hit in dropboxwsgi.caching
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(size))])
+        return environ['wsgi.file_wrapper'](open(path, 'rb'), 16 * 1024)
+    return app
+
+def fetch(port):
+    s = socket.create_connection(('127.0.0.1', port))
+    try:
+        s.sendall('GET / HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode('latin1'))
+        buf = bytearray(MIB)
+        total = 0
+        while True:
+            n = s.recv_into(buf)
+            if not n:
+                break
+            total += n
+        return total
+    finally:
+        s.close()
+
+def bench(handler_class, path, runs):
+    server = make_server('127.0.0.1', 0, make_file_app(path),
+                         handler_class=handler_class)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        best = None
+        for _ in range(runs):
+            start = time.time()
+            received = fetch(server.server_port)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return received, best
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def make_data_file(size_mib):
+    fd, path = tempfile.mkstemp(prefix='dropboxwsgi-bench-')
+    block = os.urandom(MIB)
+    with os.fdopen(fd, 'wb') as f:
+        for _ in range(size_mib):
+            f.write(block)
+    return path
+
+def main(argv):
+    opts, _ = getopt.getopt(argv[1:], '', ['size=', 'runs='])
+    opts = dict(opts)
+    size_mib = int(opts.get('--size', 2048))
+    runs = int(opts.get('--runs', 3))
+
+    if dwmain.sendfile is None:
+        sys.stderr.write("warning: no sendfile() available, both runs use the slow path\n")
+
+    path = make_data_file(size_mib)
+    try:
+        results = []
+        for (name, handler_class) in [('wsgiref', QuietRequestHandler),
+                                      ('wsgiref+sendfile', QuietSendfileRequestHandler)]:
+            received, elapsed = bench(handler_class, path, runs)
+            rate = received / float(MIB) / elapsed
+            results.append(rate)
+            sys.stdout.write("%-18s %8d MiB in %7.3fs  %9.1f MiB/s\n" %
+                             (name, received // MIB, elapsed, rate))
+        sys.stdout.write("speedup: %.2fx\n" % (results[1] / results[0]))
+    finally:
+        os.unlink(path)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
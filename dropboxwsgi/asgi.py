@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+ASGI entry point, Python 3.5+ only (so it isn't imported by the
+package itself).
+
+The WSGI app (and the caching middleware, if used) do their work on a
+thread pool: the metadata lookups and the start of the response in one
+call, then every chunk of the body in a call of its own. No thread is
+held while waiting on a slow client, and a chunk is only read from
+upstream or the cache once the client has taken the previous one, so
+responses are streamed with backpressure. Since it is the same app,
+responses are the same as the WSGI ones: caching headers, ranges,
+listings, compression and cache fills all work the same.
+
+Usage, e.g. with uvicorn:
+
+    from dropboxwsgi.asgi import make_asgi_app
+    app = make_asgi_app(config, FileSystemCredStorage(app_dir),
+                        cache=FileSystemCache(cache_dir))
+"""
+
+import asyncio
+import io
+import logging
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .main import (app_from_config, backend_from_config, with_defaults,
+                   write_behind_from_config)
+
+logger = logging.getLogger(__name__)
+
+def environ_from_scope(scope, body=b''):
+    # like a WSGI server would, paths are bytes decoded as latin1
+    raw_path = scope.get('raw_path')
+    if raw_path is None:
+        raw_path = scope['path'].encode('utf8')
+    else:
+        raw_path = raw_path.split(b'?', 1)[0]
+    root_path = scope.get('root_path', '').encode('utf8')
+    if root_path and raw_path.startswith(root_path):
+        raw_path = raw_path[len(root_path):]
+
+    (server_name, server_port) = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.decode('latin1'),
+        'PATH_INFO': raw_path.decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'SERVER_SOFTWARE': 'asgi',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for (name, value) in scope.get('headers', []):
+        key = name.decode('latin1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+    return environ
+
+class _Response(object):
+    def __init__(self):
+        self.status = None
+        self.headers = None
+        self.written = []
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.status is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = status
+        self.headers = headers
+        # for apps still using the write() callable
+        return self.written.append
+
+def wsgi_to_asgi(wsgi_app, executor):
+    """
+    Runs `wsgi_app` on `executor`, one call for the start of the
+    response and one per chunk of the body.
+    """
+
+    def start(environ):
+        res = _Response()
+        iterable = wsgi_app(environ, res.start_response)
+        it = iter(iterable)
+        first = None
+        if res.status is None:
+            # start_response() may be deferred until the first chunk
+            first = next(it, None)
+        return (res, iterable, it, first)
+
+    def close(iterable):
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+    async def app(scope, receive, send):
+        loop = asyncio.get_event_loop()
+
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        environ = environ_from_scope(scope, b''.join(body))
+        (res, iterable, it, first) = await loop.run_in_executor(executor, start, environ)
+        try:
+            await send({'type': 'http.response.start',
+                        'status': int(res.status.split(' ', 1)[0]),
+                        'headers': [(k.lower().encode('latin1'), v.encode('latin1'))
+                                    for (k, v) in res.headers]})
+
+            for data in res.written:
+                await send({'type': 'http.response.body', 'body': data,
+                            'more_body': True})
+
+            data = first
+            while True:
+                if data:
+                    await send({'type': 'http.response.body', 'body': data,
+                                'more_body': True})
+                data = await loop.run_in_executor(executor, next, it, None)
+                if data is None:
+                    break
+
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await loop.run_in_executor(executor, close, iterable)
+
+    return app
+
+def make_asgi_app(config, impl, cache=None, executor=None, backend=None):
+    """
+    ASGI version of the app the server runs (see main.app_from_config()),
+    with the caching middleware on top of it if a `cache` (e.g. a
+    FileSystemCache) is given. `backend` defaults to the one `config`
+    asks for, see main.backend_from_config().
+    """
+    config = with_defaults(config)
+    if backend is None:
+        backend = backend_from_config(config)
+    write_behind = None if cache is None else write_behind_from_config(config)
+    wsgi_app = app_from_config(config, impl, cache=cache,
+                               write_behind=write_behind, backend=backend)
+
+    if executor is None:
+        executor = ThreadPoolExecutor(config.get('asgi_threads', 32))
+
+    http_app = wsgi_to_asgi(wsgi_app, executor)
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'http':
+            await http_app(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    if write_behind is not None:
+                        loop = asyncio.get_event_loop()
+                        if not await loop.run_in_executor(None, write_behind.drain,
+                                                          config['graceful_timeout']):
+                            logger.warning("Gave up waiting for cache writes to finish")
+                    executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        else:
+            raise ValueError("Unsupported ASGI scope type: %r" % scope['type'])
+
+    app.wsgi_app = wsgi_app
+    return app
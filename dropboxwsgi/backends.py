@@ -0,0 +1,284 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Stand-ins for dropbox.client.DropboxClient. make_app() only calls
+metadata(), get_file() and (with namespace sync) delta(), and only
+looks at the `status` of the errors they raise, so anything providing
+those can be passed to it as `backend`.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import mimetypes
+import os
+import random
+import sys
+import threading
+import time
+
+from .dates import posix_to_http_date
+
+class BackendError(Exception):
+    """
+    An API error, with the attributes of dropbox.rest.ErrorResponse
+    that dropboxwsgi looks at.
+    """
+
+    def __init__(self, status, error_msg=None, reason=None):
+        Exception.__init__(self, status, error_msg)
+        self.status = status
+        self.error_msg = error_msg
+        self.reason = reason
+        self.body = {} if error_msg is None else {'error': error_msg}
+
+    def __str__(self):
+        return '[%d] %r' % (self.status, self.error_msg or self.reason)
+
+def _dropbox_date(ts):
+    return posix_to_http_date(ts)[:-len('GMT')] + '+0000'
+
+def _human_size(n):
+    if n == 1:
+        return u'1 byte'
+    for (unit, size) in [(u'TB', 1024 ** 4), (u'GB', 1024 ** 3),
+                         (u'MB', 1024 ** 2), (u'KB', 1024)]:
+        if n >= size:
+            return u'%.1f %s' % (n / float(size), unit)
+    return u'%d bytes' % n
+
+class _LocalResponse(object):
+    # looks enough like the HTTPResponse get_file() returns
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, f, length, bandwidth, sleep):
+        self._f = f
+        self._remaining = length
+        self._bandwidth = bandwidth
+        self._sleep = sleep
+        self._start = None
+        self._sent = 0
+
+    def getheader(self, name, default=None):
+        if name.lower() == 'content-length':
+            return str(self._remaining + self._sent)
+        return default
+
+    def read(self, amt=None):
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        if self._start is None:
+            self._start = time.time()
+        data = self._f.read(amt)
+        self._remaining -= len(data)
+        self._sent += len(data)
+
+        if self._bandwidth:
+            # sleep until the data could have arrived
+            ahead = self._sent / float(self._bandwidth) - (time.time() - self._start)
+            if ahead > 0:
+                self._sleep(ahead)
+        return data
+
+    def close(self):
+        self._f.close()
+
+class LocalBackend(object):
+    """
+    Serves the directory `root` the way the Dropbox API would serve
+    a Dropbox: folder hashes and 304s, file revisions, streamed
+    get_file() responses (ranges too), is_deleted entries for paths
+    that have been seen before and are now gone, and delta().
+
+    Every call waits `latency` seconds plus up to `jitter` more, fails
+    with a BackendError(`error_status`) for an `error_rate` fraction of
+    calls, and get_file() bodies arrive at `bandwidth` bytes per second
+    if that is set. Lookups are case-sensitive, unlike Dropbox, if the
+    local filesystem is.
+    """
+
+    def __init__(self, root, latency=0, jitter=0, bandwidth=0,
+                 error_rate=0, error_status=503, sleep=time.sleep,
+                 rand=random.random):
+        self.root = os.path.abspath(root)
+        if not isinstance(self.root, type(u'')):
+            # so listings and walks give us unicode names
+            self.root = self.root.decode(sys.getfilesystemencoding() or 'utf8')
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.sleep = sleep
+        self.rand = rand
+
+        # lower-cased path -> last metadata returned for it
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.jitter * self.rand()
+        if delay > 0:
+            self.sleep(delay)
+
+        if self.error_rate and self.rand() < self.error_rate:
+            raise BackendError(self.error_status, error_msg="Injected failure")
+
+    def _local_path(self, path):
+        pieces = [p for p in path.split(u'/') if p]
+        if any(p in (u'.', u'..') for p in pieces):
+            raise BackendError(400, error_msg="Invalid path %r" % path)
+        return os.path.join(self.root, *pieces)
+
+    def _stat(self, path):
+        local_path = self._local_path(path)
+        try:
+            return (local_path, os.stat(local_path))
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return (local_path, None)
+            raise
+
+    def _file_metadata(self, path, st):
+        rev = hashlib.sha1(repr((st.st_ino, st.st_size, st.st_mtime))
+                           .encode('utf8')).hexdigest()[:10]
+        return dict(path=path, is_dir=False, rev=rev, bytes=st.st_size,
+                    size=_human_size(st.st_size), modified=_dropbox_date(st.st_mtime),
+                    mime_type=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                    icon=u'page_white', root=u'dropbox', thumb_exists=False)
+
+    def _dir_metadata(self, path, st):
+        return dict(path=path, is_dir=True, bytes=0, size=u'0 bytes',
+                    modified=_dropbox_date(st.st_mtime), icon=u'folder',
+                    root=u'dropbox', thumb_exists=False)
+
+    def _metadata(self, path, local_path, st):
+        if not os.path.isdir(local_path):
+            return self._file_metadata(path, st)
+
+        md = self._dir_metadata(path, st)
+        contents = []
+        for name in sorted(os.listdir(local_path)):
+            child_path = u'%s/%s' % (path.rstrip(u'/'), name)
+            try:
+                child_st = os.stat(os.path.join(local_path, name))
+            except OSError:
+                # removed while we were looking
+                continue
+            if os.path.isdir(os.path.join(local_path, name)):
+                contents.append(self._dir_metadata(child_path, child_st))
+            else:
+                contents.append(self._file_metadata(child_path, child_st))
+
+        h = hashlib.md5()
+        for child in contents:
+            h.update(repr((child['path'], child.get('rev'), child['modified']))
+                     .encode('utf8'))
+        md['hash'] = h.hexdigest()
+        md['contents'] = contents
+        return md
+
+    def _remember(self, md):
+        with self._lock:
+            self._seen[md['path'].rstrip(u'/').lower()] = md
+            for child in md.get('contents', ()):
+                self._seen[child['path'].lower()] = child
+
+    def metadata(self, path, list=True, file_limit=25000, hash=None,
+                 rev=None, include_deleted=False):
+        self._call()
+        path = u'/' + path.strip(u'/')
+        (local_path, st) = self._stat(path)
+        if st is None:
+            with self._lock:
+                old = self._seen.get(path.rstrip(u'/').lower())
+            if old is None:
+                raise BackendError(404, error_msg="Path '%s' not found" % path)
+            return dict(path=old['path'], is_dir=old['is_dir'], is_deleted=True,
+                        rev=old.get('rev'), bytes=0, size=u'0 bytes',
+                        modified=old['modified'], root=u'dropbox')
+
+        md = self._metadata(path, local_path, st)
+        self._remember(md)
+        if md['is_dir']:
+            if hash is not None and hash == md['hash']:
+                raise BackendError(304)
+            if len(md['contents']) > file_limit:
+                raise BackendError(406, error_msg="Too many entries")
+            if not list:
+                del md['contents']
+        return md
+
+    def get_file(self, from_path, rev=None, start=None, length=None):
+        self._call()
+        (local_path, st) = self._stat(from_path)
+        if st is None or os.path.isdir(local_path):
+            raise BackendError(404, error_msg="File not found")
+        if rev is not None and rev != self._file_metadata(from_path, st)['rev']:
+            # only the current revision is available
+            raise BackendError(404, error_msg="Revision not found")
+
+        f = open(local_path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        start = start or 0
+        if start:
+            f.seek(start)
+        if length is None:
+            length = size - start
+        return _LocalResponse(f, max(0, min(length, size - start)),
+                              self.bandwidth, self.sleep)
+
+    def delta(self, cursor=None):
+        # every change resends everything, good enough for the
+        # namespace index
+        self._call()
+        entries = []
+        for (dir_path, dir_names, file_names) in os.walk(self.root):
+            rel = dir_path[len(self.root):].replace(os.sep, u'/')
+            for name in sorted(dir_names + file_names):
+                path = u'%s/%s' % (rel, name)
+                try:
+                    st = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                if name in dir_names:
+                    md = self._dir_metadata(path, st)
+                else:
+                    md = self._file_metadata(path, st)
+                entries.append([path.lower(), md])
+
+        h = hashlib.md5()
+        for (_, md) in entries:
+            h.update(repr((md['path'], md.get('rev'), md['modified'])).encode('utf8'))
+        new_cursor = h.hexdigest()
+
+        if new_cursor == cursor:
+            return dict(entries=[], reset=False, cursor=cursor, has_more=False)
+        return dict(entries=entries, reset=True, cursor=new_cursor, has_more=False)
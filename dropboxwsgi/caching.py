@@ -22,14 +22,20 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import collections
+import contextlib
 import errno
+import hashlib
+import io
 import itertools
 import operator
 import os
-import logging
 import shutil
-import sys
+import logging
+import sqlite3
 import tempfile
+import threading
+import time
 
 try:
     import json
@@ -38,26 +44,358 @@ except Exception:
 
 from wsgiref.util import FileWrapper
 
+from .compression import (ALL_ENCODINGS, compress_stream, encoded_headers,
+                          is_compressible, negotiate, strip_variant_etag)
+from .metrics import cache_fills_dropped, cache_requests, cache_write_queue_bytes
+from .ranges import range_response, read_file_range, requested_ranges
 from .six import r
+from .timing import timed
+from .util import ClosingIterator, LRUCache
 
 logger = logging.getLogger(__name__)
 
+class CacheIndex(object):
+    """
+    Persistent record of what is in a FileSystemCache: the path
+    entries with their response headers, when they were last used,
+    when they were last known to be current and which blob holds their
+    data, and the blobs with their sizes and reference counts. Stored
+    in SQLite so it can be shared by every process using the same cache
+    directory.
+
+    Entries that are looked up are kept in memory, and forgotten as
+    soon as another process changes the index.
+    """
+
+    SCHEMA_VERSION = 4
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS blobs (
+               key TEXT PRIMARY KEY,
+               size INTEGER NOT NULL,
+               refs INTEGER NOT NULL DEFAULT 0)""",
+        "CREATE INDEX IF NOT EXISTS blobs_refs ON blobs (refs)",
+        """CREATE TABLE IF NOT EXISTS entries (
+               path TEXT PRIMARY KEY,
+               blob TEXT NOT NULL,
+               headers TEXT NOT NULL,
+               atime REAL NOT NULL,
+               validated REAL NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)",
+        # keep running totals so checking the limits is cheap
+        """CREATE TABLE IF NOT EXISTS totals (
+               id INTEGER PRIMARY KEY CHECK (id = 0),
+               entries INTEGER NOT NULL,
+               bytes INTEGER NOT NULL)""",
+        "INSERT OR IGNORE INTO totals VALUES (0, 0, 0)",
+        # and the blob reference counts
+        """CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+           BEGIN
+               UPDATE totals SET entries = entries + 1;
+               UPDATE blobs SET refs = refs + 1 WHERE key = NEW.blob;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+           BEGIN
+               UPDATE totals SET entries = entries - 1;
+               UPDATE blobs SET refs = refs - 1 WHERE key = OLD.blob;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF blob ON entries
+           BEGIN
+               UPDATE blobs SET refs = refs - 1 WHERE key = OLD.blob;
+               UPDATE blobs SET refs = refs + 1 WHERE key = NEW.blob;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS blobs_insert AFTER INSERT ON blobs
+           BEGIN UPDATE totals SET bytes = bytes + NEW.size; END""",
+        """CREATE TRIGGER IF NOT EXISTS blobs_delete AFTER DELETE ON blobs
+           BEGIN UPDATE totals SET bytes = bytes - OLD.size; END""",
+        """CREATE TRIGGER IF NOT EXISTS blobs_update AFTER UPDATE OF size ON blobs
+           BEGIN UPDATE totals SET bytes = bytes - OLD.size + NEW.size; END""",
+    ]
+
+    # access times are only written out this often
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, db_path, memo_size=10000):
+        self.db_path = db_path
+        # true if the index had to be created, or recreated because
+        # it was written by another version of this code
+        self.created = not os.path.exists(db_path)
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._touched = {}
+        self._last_flush = time.time()
+        # path -> (headers, blob key, validated), or None if missing
+        self._memo = LRUCache(memo_size)
+        self._data_version = None
+
+    def _connection(self):
+        # connections can't be shared with forked children
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                (version,) = conn.execute("PRAGMA user_version").fetchone()
+                if version != self.SCHEMA_VERSION:
+                    if version:
+                        logger.info("Recreating cache index %r", self.db_path)
+                    for (type_, name) in conn.execute(
+                        "SELECT type, name FROM sqlite_master "
+                        "WHERE type IN ('table', 'trigger')").fetchall():
+                        conn.execute("DROP %s IF EXISTS %s" % (type_, name))
+                    self.created = True
+                for stmt in self.SCHEMA:
+                    conn.execute(stmt)
+                conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            self._conn = conn
+            self._pid = os.getpid()
+            self._memo.clear()
+        return self._conn
+
+    def _check_memo(self, conn):
+        # data_version changes when another connection commits, reading
+        # it only touches the WAL index in shared memory
+        (version,) = conn.execute("PRAGMA data_version").fetchone()
+        if version != self._data_version:
+            self._memo.clear()
+            self._data_version = version
+
+    def open(self):
+        with self._lock:
+            self._connection()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Holds the index write lock, across all processes, for the
+        duration of the block.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def _query(self, sql, args=(), conn=None):
+        with self._lock:
+            if conn is None:
+                conn = self._connection()
+            return conn.execute(sql, args).fetchall()
+
+    def has_blob(self, key, conn=None):
+        return bool(self._query("SELECT 1 FROM blobs WHERE key = ?", (key,), conn))
+
+    def add_blob(self, key, size, conn):
+        conn.execute("INSERT INTO blobs (key, size) VALUES (?, ?)", (key, size))
+
+    def grow_blob(self, key, size, conn):
+        conn.execute("UPDATE blobs SET size = size + ? WHERE key = ?", (size, key))
+
+    def set_entry(self, path, key, headers, conn, validated=None):
+        now = time.time()
+        if validated is None:
+            validated = now
+        headers = json.dumps(headers)
+        self._memo.pop(path)
+        if not conn.execute("UPDATE entries SET blob = ?, headers = ?, atime = ?, validated = ? "
+                            "WHERE path = ?", (key, headers, now, validated, path)).rowcount:
+            conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                         (path, key, headers, now, validated))
+
+    def lookup(self, path):
+        """
+        Returns (headers, blob key, validated) for `path`, or None.
+        """
+        with self._lock:
+            conn = self._connection()
+            self._check_memo(conn)
+            entry = self._memo.get(path, False)
+            if entry is not False:
+                return entry
+
+            res = conn.execute("SELECT headers, blob, validated FROM entries "
+                               "WHERE path = ?", (path,)).fetchall()
+            if res:
+                (headers, key, validated) = res[0]
+                entry = ([(r(k), r(v)) for (k, v) in json.loads(headers)],
+                         r(key), validated)
+            else:
+                entry = None
+            self._memo.set(path, entry)
+            return entry
+
+    def validated(self, path):
+        entry = self.lookup(path)
+        return None if entry is None else entry[2]
+
+    def set_validated(self, path, when=None):
+        with self.transaction() as conn:
+            self._memo.pop(path)
+            conn.execute("UPDATE entries SET validated = ? WHERE path = ?",
+                         (time.time() if when is None else when, path))
+
+    def remove_entry(self, path, conn):
+        self._memo.pop(path)
+        conn.execute("DELETE FROM entries WHERE path = ?", (path,))
+        self._touched.pop(path, None)
+
+    def unreferenced_blobs(self, conn):
+        return [key for (key,) in
+                conn.execute("SELECT key FROM blobs WHERE refs <= 0").fetchall()]
+
+    def remove_blob(self, key, conn):
+        conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+
+    def touch(self, path):
+        now = time.time()
+        self._touched[path] = now
+        if now - self._last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            touched = self._touched
+            self._touched = {}
+            self._last_flush = time.time()
+            if touched:
+                with self.transaction() as conn:
+                    conn.executemany("UPDATE entries SET atime = ? WHERE path = ?",
+                                     [(v, k) for (k, v) in touched.iteritems()])
+
+    def close(self):
+        # the next call reconnects, e.g. from a forked child
+        with self._lock:
+            if self._pid == os.getpid():
+                self.flush()
+                self._conn.close()
+            self._conn = None
+            self._pid = None
+            self._memo.clear()
+
+    def totals(self, conn=None):
+        return self._query("SELECT entries, bytes FROM totals", (), conn)[0]
+
+    def least_recently_used(self, conn, limit):
+        return [path for (path,) in
+                conn.execute("SELECT path FROM entries ORDER BY atime LIMIT ?",
+                             (limit,)).fetchall()]
+
 class FileSystemCache(object):
+    """
+    Path entries, with their response headers and the key of the blob
+    holding the response body, are kept in the CacheIndex. Blobs are
+    keyed by content (see _blob_key()) so paths serving the same file
+    revision share one copy of it. They are spread over two levels of
+    directories by the first hex digits of their key, see _blob_path().
+    Compressed variants of a blob are stored next to it and count
+    towards its size.
+
+    Older versions kept each entry in a TAG_NAME file, in a tree under
+    cache_dir that mirrors the served paths, and all blobs in blob_dir
+    itself. Those are moved to where they belong when the cache is
+    opened, see migrate().
+    """
+
     TAG_NAME = 'tag.txt'
     DATA_NAME = 'data.bin'
     DIR_INTER = 'dir'
+    INDEX_NAME = 'index.db'
+
+    # number of entries to look at per eviction round
+    EVICT_BATCH = 64
 
-    def __init__(self, app_dir):
+    # temporary files untouched for this long belong to fills that
+    # will never finish, e.g. because the server was killed
+    ORPHAN_AGE = 10 * 60
+
+    def __init__(self, app_dir, max_bytes=None, max_entries=None, memo_size=10000):
         self.tmp_dir = os.path.join(app_dir, 'tmp')
         self.cache_dir = os.path.join(app_dir, 'cache')
+        self.blob_dir = os.path.join(app_dir, 'blobs')
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
 
         # if these fail, let the exception raise
         # TODO: blow these away if they are files
         # TODO: check permissions
-        for p in [self.cache_dir, self.tmp_dir]:
+        for p in [self.blob_dir, self.tmp_dir]:
             self._makedirs(p)
 
+        self.migrate()
+        self.sweep_tmp()
+
+        self.index = CacheIndex(os.path.join(app_dir, self.INDEX_NAME), memo_size)
+        self.index.open()
+        if self.index.created:
+            self._rebuild_index()
+        self._evict()
+
+    def migrate(self):
+        """
+        Moves blobs stored directly in blob_dir by older versions into
+        their fan-out directories, returns how many were moved.
+        """
+        moved = 0
+        for name in os.listdir(self.blob_dir):
+            if len(name) <= 2:
+                # a fan-out directory
+                continue
+            (key, _, encoding) = name.partition('.')
+            dst = self._variant_path(key, encoding) if encoding else self._blob_path(key)
+            self._rename_into(os.path.join(self.blob_dir, name), dst)
+            moved += 1
+        if moved:
+            logger.info("Moved %d blobs into fan-out directories in %r", moved, self.blob_dir)
+        return moved
+
+    def sweep_tmp(self, max_age=None):
+        """
+        Removes temporary files left behind by fills that never
+        finished, returns how many were removed. Other processes using
+        the cache might still be writing the newer ones, so only files
+        older than `max_age` (ORPHAN_AGE by default) seconds go.
+        Older versions used temporary directories, those go too.
+        """
+        if max_age is None:
+            max_age = self.ORPHAN_AGE
+        cutoff = time.time() - max_age
+
+        removed = 0
+        for name in os.listdir(self.tmp_dir):
+            p = os.path.join(self.tmp_dir, name)
+            try:
+                if os.lstat(p).st_mtime > cutoff:
+                    continue
+                if os.path.isdir(p) and not os.path.islink(p):
+                    shutil.rmtree(p)
+                else:
+                    os.unlink(p)
+            except EnvironmentError, e:
+                # someone else got to it first
+                if e.errno != errno.ENOENT:
+                    # not worth failing to start over
+                    logger.warning("Couldn't remove temporary file %r: %s", p, e)
+            else:
+                removed += 1
+        if removed:
+            logger.info("Removed %d abandoned temporary files from %r", removed, self.tmp_dir)
+        return removed
+
     def _generate_cache_path(self, path):
+        # where older versions kept the entry for `path`
         top = self.cache_dir
         pieces = path.split('/')
 
@@ -70,6 +408,165 @@ class FileSystemCache(object):
 
         return os.path.join(parent_dir, pieces[-1])
 
+    @classmethod
+    def _blob_key(cls, path, etag):
+        # file ETags ("_<rev>") identify the content no matter which
+        # path it is served from, anything else (e.g. directory
+        # listings, which contain their own path) is per path
+        if etag.startswith('"_'):
+            material = etag
+        else:
+            material = u'%s\0%s' % (path, etag)
+        return hashlib.sha1(material.encode('utf8')).hexdigest()
+
+    def _blob_path(self, key):
+        # keys are hex digests, so this spreads blobs evenly
+        # over 65536 directories
+        return os.path.join(self.blob_dir, key[0:2], key[2:4], key)
+
+    def _iter_blob_names(self):
+        for top in os.listdir(self.blob_dir):
+            top_path = os.path.join(self.blob_dir, top)
+            for sub in os.listdir(top_path):
+                for name in os.listdir(os.path.join(top_path, sub)):
+                    yield name
+
+    @classmethod
+    def _rename_into(cls, src, dst):
+        # creates the fan-out directories on demand
+        try:
+            os.rename(src, dst)
+        except OSError, e:
+            if e.errno != errno.ENOENT or not os.path.exists(src):
+                raise
+            cls._makedirs(os.path.dirname(dst))
+            os.rename(src, dst)
+
+    def _variant_path(self, key, encoding):
+        return '%s.%s' % (self._blob_path(key), encoding)
+
+    def _iter_entries(self):
+        # inverse of _generate_cache_path(), yields (path, tag file)
+        # for every entry in the cache directory
+        for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+            if self.TAG_NAME not in filenames:
+                continue
+
+            rel = os.path.relpath(dirpath, self.cache_dir)
+            pieces = [] if rel == os.curdir else rel.split(os.sep)
+            path = '/' + '/'.join(pieces[::2])
+            if len(pieces) % 2 == 0 and pieces:
+                # ends with DIR_INTER, so this is a directory listing
+                path += '/'
+
+            yield (path.decode('utf8') if isinstance(path, bytes) else path,
+                   os.path.join(dirpath, self.TAG_NAME))
+
+    def _rebuild_index(self):
+        # only happens when the index is missing or from an old version
+        logger.info("Building cache index for %r", self.blob_dir)
+        with self.index.transaction() as conn:
+            names = list(self._iter_blob_names())
+            blobs = set(name for name in names if '.' not in name)
+            for key in blobs:
+                self.index.add_blob(key, os.path.getsize(self._blob_path(key)), conn)
+
+            for name in names:
+                (key, _, encoding) = name.partition('.')
+                if not encoding:
+                    continue
+                if key in blobs:
+                    self.index.grow_blob(key, os.path.getsize(self._variant_path(key, encoding)), conn)
+                else:
+                    os.unlink(self._variant_path(key, encoding))
+
+            for (path, tag_path) in list(self._iter_entries()):
+                try:
+                    with open(tag_path, 'r') as f:
+                        res = json.load(f)
+                    key = res['blob']
+                    headers = res['headers']
+                except Exception:
+                    key = None
+
+                if key in blobs:
+                    # we have no idea how old it is
+                    self.index.set_entry(path, key, headers, conn, validated=0)
+                # broken, or from before blobs existed, if not
+                self._remove_entry_files(os.path.dirname(tag_path))
+
+            # and what's left of the old tree
+            for (dirpath, _, _) in os.walk(self.cache_dir, topdown=False):
+                try:
+                    os.rmdir(dirpath)
+                except EnvironmentError:
+                    pass
+
+            self._collect_garbage(conn)
+
+    def _over_limits(self, entries, bytes_):
+        return ((self.max_entries and entries > self.max_entries) or
+                (self.max_bytes and bytes_ > self.max_bytes))
+
+    def _remove_entry_files(self, cache_path):
+        # don't rmtree(), entries for directory listings
+        # contain the entries of their children
+        for name in [self.TAG_NAME, self.DATA_NAME]:
+            try:
+                os.unlink(os.path.join(cache_path, name))
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        try:
+            os.rmdir(cache_path)
+        except EnvironmentError:
+            pass
+
+    def _collect_garbage(self, conn):
+        for key in self.index.unreferenced_blobs(conn):
+            logger.debug("Removing unused blob %r", key)
+            for blob_path in itertools.chain([self._blob_path(key)],
+                                             (self._variant_path(key, encoding)
+                                              for encoding in ALL_ENCODINGS)):
+                try:
+                    os.unlink(blob_path)
+                except EnvironmentError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            self.index.remove_blob(key, conn)
+
+    def _evict(self):
+        if not (self.max_bytes or self.max_entries):
+            return
+
+        (entries, bytes_) = self.index.totals()
+        if not self._over_limits(entries, bytes_):
+            return
+
+        # make sure the access order is up to date
+        self.index.flush()
+
+        # this holds the index write lock, so no entry
+        # can be committed while we are removing files
+        with self.index.transaction() as conn:
+            while True:
+                (entries, bytes_) = self.index.totals(conn)
+                if not self._over_limits(entries, bytes_):
+                    break
+
+                victims = self.index.least_recently_used(conn, self.EVICT_BATCH)
+                if not victims:
+                    break
+
+                for path in victims:
+                    logger.debug("Evicting %r from cache", path)
+                    self.index.remove_entry(path, conn)
+                    # shared blobs only go away with their last path
+                    self._collect_garbage(conn)
+                    (entries, bytes_) = self.index.totals(conn)
+                    if not self._over_limits(entries, bytes_):
+                        break
+
     @classmethod
     def _makedirs(cls, path):
         try:
@@ -80,37 +577,102 @@ class FileSystemCache(object):
             elif not os.path.isdir(path):
                 raise Exception("Not a directory: %r" % path)
 
-    def read_cached_headers(self, path):
-        cache_path = self._generate_cache_path(path)
-        with open(os.path.join(cache_path, self.TAG_NAME), 'r') as f:
-            try:
-                res = json.load(f)
-            except ValueError:
-                logger.exception("Bad data in metadata file!")
-                res = None
+    def _read_entry(self, path):
+        entry = self.index.lookup(path)
+        if entry is None:
+            raise IOError(errno.ENOENT, "Not cached", path)
 
-        if res:
-            try:
-                res = [(r(k), r(v)) for (k, v) in res]
-            except Exception:
-                logger.exception("Bad data in metadata file!")
+        self.index.touch(path)
+        # callers (and servers) may add to the headers
+        return (list(entry[0]), entry[1])
 
-        if not res:
-            self.drop_cached_data(path)
-            raise Exception("Bad data in metadata file!")
-        else:
-            return res
+    def close(self):
+        self.index.close()
+
+    def read_cached_headers(self, path):
+        return self._read_entry(path)[0]
 
     def drop_cached_data(self, path):
-        try:
-            shutil.rmtree(self._generate_cache_path(path))
-        except EnvironmentError, e:
-            if e.errno != errno.ENOENT:
-                raise
+        with self.index.transaction() as conn:
+            self.index.remove_entry(path, conn)
+            self._collect_garbage(conn)
 
     def read_cached_data(self, path):
-        cache_path = self._generate_cache_path(path)
-        return open(os.path.join(cache_path, self.DATA_NAME), 'rb')
+        return open(self._blob_path(self._read_entry(path)[1]), 'rb')
+
+    def read_cached_variant(self, path, encoding):
+        return open(self._variant_path(self._read_entry(path)[1], encoding), 'rb')
+
+    def write_cached_variant(self, path, encoding):
+        """
+        Returns a writer for the `encoding`-compressed version of
+        the data cached for `path`, it's only kept if done() is called.
+        """
+        s1 = self
+        key = self._read_entry(path)[1]
+        class VariantWriter(object):
+            def __init__(self):
+                fd, self.path = tempfile.mkstemp(dir=s1.tmp_dir)
+                self.f = os.fdopen(fd, 'wb')
+                self.size = 0
+
+            def write(self, data):
+                self.f.write(data)
+                self.size += len(data)
+
+            def done(self):
+                self.f.close()
+                self.f = None
+                variant_path = s1._variant_path(key, encoding)
+                with s1.index.transaction() as conn:
+                    # the blob may have been evicted in the meantime,
+                    # or someone else may have beaten us to it
+                    if (s1.index.has_blob(key, conn) and
+                        not os.path.exists(variant_path)):
+                        s1._rename_into(self.path, variant_path)
+                        self.path = None
+                        s1.index.grow_blob(key, self.size, conn)
+                s1._evict()
+
+            def close(self):
+                if self.f is not None:
+                    self.f.close()
+                    self.f = None
+                if self.path is not None:
+                    os.unlink(self.path)
+                    self.path = None
+
+        return VariantWriter()
+
+    def cached_age(self, path):
+        """
+        Seconds since the data cached for `path` was last known to be
+        current, None if there is none.
+        """
+        validated = self.index.validated(path)
+        if validated is None:
+            return None
+        return max(0, time.time() - validated)
+
+    def mark_validated(self, path):
+        self.index.set_validated(path)
+
+    def has_etag(self, path, etag):
+        """
+        Returns True if data for `etag` is stored, so `path` can be
+        pointed at it with link_cached_data() without downloading it.
+        """
+        return self.index.has_blob(self._blob_key(path, etag))
+
+    def link_cached_data(self, path, headers):
+        etag = get_from_alist(headers, 'etag', key=methodcaller('lower'))
+        key = self._blob_key(path, etag)
+        with self.index.transaction() as conn:
+            if not self.index.has_blob(key, conn):
+                raise Exception("Blob is gone: %r" % key)
+            self.index.set_entry(path, key, headers, conn)
+            self._collect_garbage(conn)
+        self._evict()
 
     def write_cached_data(self, path, headers):
         s1 = self
@@ -118,9 +680,19 @@ class FileSystemCache(object):
             def __init__(self):
                 fd, self.path = tempfile.mkstemp(dir=s1.tmp_dir)
                 self.f = os.fdopen(fd, 'wb')
+                self.size = 0
 
             def write(self, data):
                 self.f.write(data)
+                self.size += len(data)
+
+            def flush(self):
+                self.f.flush()
+
+            def open_partial(self):
+                # unbuffered, so reads past the current end of
+                # the file pick up later writes
+                return io.open(self.path, 'rb', buffering=0)
 
             def done(self):
                 unlink = True
@@ -128,29 +700,32 @@ class FileSystemCache(object):
                     self.f.close()
                     self.f = None
 
-                    tmp_source_path = tempfile.mkdtemp(dir=s1.tmp_dir)
-
-                    os.rename(self.path, os.path.join(tmp_source_path, s1.DATA_NAME))
-                    unlink = False
-                    with open(os.path.join(tmp_source_path, s1.TAG_NAME), 'w') as f:
-                        json.dump(headers, f)
+                    etag = get_from_alist(headers, 'etag', key=methodcaller('lower'))
+                    key = s1._blob_key(path, etag)
 
-                    cache_path = s1._generate_cache_path(path)
-                    try:
-                        shutil.rmtree(cache_path)
-                    except EnvironmentError, e:
-                        if e.errno != errno.ENOENT:
-                            logger.exception("Couldn't remove %r before renaming over it", cache_path)
+                    # eviction can't run while we swap the entry in
+                    with s1.index.transaction() as conn:
+                        if not s1.index.has_blob(key, conn):
+                            s1._rename_into(self.path, s1._blob_path(key))
+                            unlink = False
+                            s1.index.add_blob(key, self.size, conn)
 
-                    s1._makedirs(os.path.dirname(cache_path))
-                    os.rename(tmp_source_path, cache_path)
+                        s1.index.set_entry(path, key, headers, conn)
+                        # the blob this path used to point at might be unused now
+                        s1._collect_garbage(conn)
                 finally:
                     if unlink:
                         os.unlink(self.path)
 
+                s1._evict()
+
             def close(self):
                 if self.f is not None:
                     self.f.close()
+                    self.f = None
+                    # never committed, anyone still reading it
+                    # already has it open
+                    os.unlink(self.path)
 
             def __enter__(self):
                 return self
@@ -177,19 +752,612 @@ def get_from_alist(alist, k, key=identity):
         if key(kc) == k:
             return vc
 
-def make_caching(impl):
+class _Fill(object):
+    """
+    A cache fill in progress. Concurrent requests for the same version
+    of a file stream from the temporary file while it's being written
+    instead of fetching it themselves.
+    """
+
+    PENDING, STREAMING, DONE, FAILED = range(4)
+
+    # give up on a fill if it makes no progress for this long
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, etag):
+        self.etag = etag
+        self.cond = threading.Condition()
+        self.state = self.PENDING
+        self.headers = None
+        self.writer = None
+        self.size = 0
+
+    def start(self, headers, writer):
+        with self.cond:
+            if hasattr(writer, 'open_partial'):
+                self.headers = headers
+                self.writer = writer
+                self.state = self.STREAMING
+            else:
+                # the storage implementation can't share its writes
+                self.state = self.FAILED
+            self.cond.notify_all()
+
+    def wrote(self, size):
+        if self.state != self.STREAMING:
+            return
+        self.writer.flush()
+        with self.cond:
+            self.size += size
+            self.cond.notify_all()
+
+    def commit(self, done):
+        # followers open the temporary file under this lock,
+        # so nobody can try to open it after it's gone
+        with self.cond:
+            done()
+            if self.state == self.STREAMING:
+                self.state = self.DONE
+            self.cond.notify_all()
+
+    def finish(self, ok):
+        with self.cond:
+            if not ok and self.state != self.DONE:
+                self.state = self.FAILED
+            self.cond.notify_all()
+
+    def _wait(self, pred):
+        # returns False if the fill made no progress for too long
+        last = (self.state, self.size)
+        deadline = time.time() + self.IDLE_TIMEOUT
+        while not pred():
+            now = time.time()
+            if (self.state, self.size) != last:
+                last = (self.state, self.size)
+                deadline = now + self.IDLE_TIMEOUT
+            elif now >= deadline:
+                self.state = self.FAILED
+                self.cond.notify_all()
+                return False
+            self.cond.wait(min(deadline - now, 1.0))
+        return True
+
+    def open(self, resume):
+        """
+        Waits for the fill to start, returns (state, headers, reader).
+        The reader is only returned while STREAMING. If the fill fails
+        later on, the reader calls `resume(offset)` for an iterable of
+        the rest of the data from that offset.
+        """
+        with self.cond:
+            self._wait(lambda: self.state != self.PENDING)
+            if self.state == self.STREAMING:
+                return (self.state, self.headers,
+                        _FillReader(self, self.writer.open_partial(), resume))
+            return (self.state, self.headers, None)
+
+class _FillReader(object):
+    def __init__(self, fill, f, resume):
+        self.fill = fill
+        self.f = f
+        self.resume = resume
+        length = get_from_alist(fill.headers, 'content-length', key=methodcaller('lower'))
+        self.length = None if length is None else int(length)
+        # (iterator, pending data, position) once we are reading
+        # what the fill didn't get to from upstream
+        self.rest = None
+
+    def _read_rest(self, size):
+        (it, pending, pos) = self.rest
+        while not pending:
+            try:
+                pending = it.next()
+            except StopIteration:
+                return pending
+        if size < 0:
+            size = len(pending)
+        self.rest = (it, pending[size:], pos + min(size, len(pending)))
+        return pending[:size]
+
+    def _close_rest(self):
+        if self.rest is not None:
+            (it, _, _) = self.rest
+            self.rest = None
+            if hasattr(it, 'close'):
+                it.close()
+
+    def read(self, size=-1):
+        while True:
+            if self.rest is not None:
+                return self._read_rest(size)
+
+            data = self.f.read(size)
+            if data:
+                return data
+
+            fill = self.fill
+            pos = self.f.tell()
+            with fill.cond:
+                if (not fill._wait(lambda: (fill.size > pos or
+                                            fill.state != fill.STREAMING)) or
+                    fill.state == fill.FAILED):
+                    # whoever was filling it stopped, the data we
+                    # already have is still good though
+                    failed = True
+                elif fill.state == fill.DONE and fill.size <= pos:
+                    return data
+                else:
+                    failed = False
+
+            if failed:
+                if self.length is not None and pos >= self.length:
+                    return data
+                logger.debug("Cache fill failed, resuming from %d", pos)
+                self.rest = (iter(self.resume(pos)), data, pos)
+
+    def seek(self, offset, whence=0):
+        self._close_rest()
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        if self.rest is not None:
+            return self.rest[2]
+        return self.f.tell()
+
+    def close(self):
+        try:
+            self._close_rest()
+        finally:
+            self.f.close()
+
+class _FillJob(object):
+    # drives a make_writer() generator, calling finish(ok) once
+    def __init__(self, path, writer, finish):
+        self.path = path
+        self.writer = writer
+        self.finish = finish
+        self.started = False
+        self.abandoned = False
+        self.done = False
+        self.finished = False
+
+    def _finish(self, ok):
+        if not self.finished:
+            self.finished = True
+            self.finish(ok)
+
+    def fail(self):
+        # lets anyone following the fill know it won't be saved,
+        # before the writer gets around to cleaning it up
+        self._finish(False)
+
+    def step(self, data):
+        if self.done:
+            return
+        if not self.started:
+            self.started = True
+            self.writer.next()
+        if data:
+            self.writer.send(data)
+            return
+
+        self.done = True
+        ok = False
+        try:
+            try:
+                self.writer.send('')
+            except StopIteration:
+                pass
+            ok = True
+        finally:
+            self._finish(ok)
+
+    def abort(self):
+        if self.done:
+            return
+        self.done = True
+        try:
+            self.writer.close()
+        finally:
+            self._finish(False)
+
+class _SyncWriter(object):
+    # saves each chunk before it is sent on
+    def write(self, job, data):
+        job.step(data)
+
+    def close(self, job):
+        job.step('')
+
+    def abandon(self, job):
+        job.abort()
+
+class WriteBehind(object):
+    """
+    Saves cache fills on a background thread (a greenlet if gevent has
+    patched threading), so responses never wait on the cache's disk.
+    At most `max_bytes` of response data waits to be written; a fill
+    that would go over that is abandoned instead of holding up its
+    response.
+    """
+
+    def __init__(self, max_bytes):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive: %r" % max_bytes)
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        # (job, data), data is '' to commit, None to abandon
+        self.queue = collections.deque()
+        self.queued = 0
+        self.busy = False
+        self.thread = None
+        self.dropped = 0
+
+    def _put(self, job, data):
+        size = len(data) if data else 0
+        dropped = False
+        with self.cond:
+            if job.abandoned:
+                return
+            if size and self.queued + size > self.max_bytes:
+                logger.warning("Cache writes are falling behind, not saving %r", job.path)
+                self.dropped += 1
+                cache_fills_dropped.inc(1, 'queue_full')
+                (data, size) = (None, 0)
+                dropped = True
+            if data is None:
+                job.abandoned = True
+
+            self.queue.append((job, data))
+            self.queued += size
+            cache_write_queue_bytes.inc(size)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='cache-writer')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+        if dropped:
+            # requests following the fill fetch the rest themselves
+            # (see _FillReader) instead of waiting for the writer to
+            # get through what is ahead of it in the queue
+            job.fail()
+
+    def write(self, job, data):
+        if data:
+            self._put(job, data)
+
+    def close(self, job):
+        self._put(job, '')
+
+    def abandon(self, job):
+        self._put(job, None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                while not self.queue:
+                    self.cond.wait()
+                (job, data) = self.queue.popleft()
+                size = len(data) if data else 0
+                self.queued -= size
+                cache_write_queue_bytes.dec(size)
+                # the rest of an abandoned fill is thrown away
+                if job.abandoned and data is not None:
+                    continue
+                self.busy = True
+
+            try:
+                if data is None:
+                    job.abort()
+                else:
+                    job.step(data)
+            except Exception:
+                logger.exception("Couldn't save %r to the cache", job.path)
+                cache_fills_dropped.inc(1, 'error')
+                with self.cond:
+                    job.abandoned = True
+                try:
+                    job.abort()
+                except Exception:
+                    logger.exception("Couldn't clean up cache fill for %r", job.path)
+
+    def drain(self, timeout=None):
+        """
+        Waits for queued writes to finish, returns False if they
+        didn't within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.queue or self.busy:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+def make_caching(impl, compress=False, max_age=0,
+                 stale_while_revalidate=0, stale_if_error=0,
+                 write_behind=None, finish_fill_bytes=0):
+    """
+    Cached entries younger than `max_age` seconds are served without
+    asking the app. For `stale_while_revalidate` seconds after that
+    they are still served straight away while they are revalidated in
+    the background, and for `stale_if_error` seconds after `max_age`
+    they are served if the app fails.
+
+    New data is written to `impl` as it is sent unless a WriteBehind
+    is given to do it in the background. If a client goes away with at
+    most `finish_fill_bytes` of its response left, the rest is still
+    read and saved.
+    """
+    # path -> _Fill, shared by every request going through this middleware
+    fills = {}
+    fills_lock = threading.Lock()
+    block_size = 16 * 1024
+    fill_writer = _SyncWriter() if write_behind is None else write_behind
+
+    # paths being revalidated in the background
+    revalidating = set()
+    revalidating_lock = threading.Lock()
+
+    use_freshness = bool((max_age or stale_while_revalidate or stale_if_error) and
+                         hasattr(impl, 'cached_age'))
+
+    def cached_age(path):
+        try:
+            return impl.cached_age(path)
+        except Exception:
+            logger.exception("Couldn't read cache entry age")
+            return None
+
+    def mark_validated(path):
+        try:
+            impl.mark_validated(path)
+        except Exception:
+            logger.exception("Couldn't mark cache entry as validated")
+
+    def should_encode(h, encoding):
+        if encoding is None:
+            return False
+        content_type = get_from_alist(h, 'content-type', key=methodcaller('lower'))
+        length = get_from_alist(h, 'content-length', key=methodcaller('lower'))
+        return (content_type is not None and
+                is_compressible(content_type, None if length is None else int(length)))
+
+    def serve_variant(environ, start_response, path, h, encoding, is_head):
+        # compressed copies are made once and kept next to the data
+        environ['dropboxwsgi.cache_variant'] = True
+        f = None
+        if hasattr(impl, 'read_cached_variant'):
+            try:
+                with timed(environ, 'cache-open'):
+                    f = impl.read_cached_variant(path, encoding)
+            except Exception, e:
+                if not (isinstance(e, EnvironmentError) and e.errno == errno.ENOENT):
+                    logger.exception("Couldn't read cached variant")
+
+        if f is not None:
+            start_response('200 OK', encoded_headers(h, encoding,
+                                                     os.fstat(f.fileno()).st_size))
+            if is_head:
+                f.close()
+                return []
+            return environ.get('wsgi.file_wrapper', FileWrapper)(f, block_size)
+
+        if is_head:
+            start_response('200 OK', encoded_headers(h, encoding))
+            return []
+
+        # open before responding so a missing file can still be fetched
+        with timed(environ, 'cache-open'):
+            f = impl.read_cached_data(path)
+        start_response('200 OK', encoded_headers(h, encoding))
+        data = compress_stream(encoding, FileWrapper(f, block_size))
+        if not hasattr(impl, 'write_cached_variant'):
+            return data
+
+        try:
+            w = impl.write_cached_variant(path, encoding)
+        except Exception:
+            logger.exception("Couldn't save cached variant")
+            return data
+
+        def close():
+            try:
+                data.close()
+            finally:
+                w.close()
+
+        def variant_res():
+            try:
+                for d in data:
+                    w.write(d)
+                    yield d
+                w.done()
+            finally:
+                close()
+        return ClosingIterator(variant_res(), close)
+
+    def serve_data(environ, start_response, h, f, file_wrapper):
+        length = get_from_alist(h, 'content-length', key=methodcaller('lower'))
+        ranges = None
+        if length is not None:
+            etag = get_from_alist(h, 'etag', key=methodcaller('lower'))
+            last_modified = get_from_alist(h, 'last-modified', key=methodcaller('lower'))
+            ranges = requested_ranges(environ, int(length), etag, last_modified)
+
+        if ranges is not None:
+            base = f.tell()
+            def read_range(start, end):
+                return read_file_range(f, base, start, end, block_size)
+            ranged = range_response(start_response, ranges, int(length),
+                                    h, read_range)
+            def ranged_res():
+                try:
+                    for d in ranged:
+                        yield d
+                finally:
+                    f.close()
+            return ClosingIterator(ranged_res(), f.close)
+        else:
+            start_response('200 OK', h)
+            return file_wrapper(f, block_size)
+
+    def release(path, fill, ok):
+        with fills_lock:
+            if fills.get(path) is fill:
+                del fills[path]
+        fill.finish(ok)
+
+    def finish_fill(path, job, it, res, limit):
+        # reads the rest of an abandoned response into the cache
+        def run():
+            ok = False
+            try:
+                read = 0
+                for d in it:
+                    read += len(d)
+                    if read > limit:
+                        logger.debug("Response is bigger than it said, not saving: %r", path)
+                        cache_fills_dropped.inc(1, 'disconnect')
+                        break
+                    fill_writer.write(job, d)
+                else:
+                    fill_writer.close(job)
+                    ok = True
+            except Exception:
+                logger.exception("Couldn't finish saving %r", path)
+            finally:
+                try:
+                    if hasattr(res, 'close'):
+                        res.close()
+                finally:
+                    if not ok:
+                        fill_writer.abandon(job)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def record(environ, result):
+        if environ.get('dropboxwsgi.revalidate'):
+            result = 'revalidate'
+        environ['dropboxwsgi.cache'] = result
+        cache_requests.inc(1, result)
+
+    def sub_environ(environ, **extra):
+        # a plain GET for the same path, without anything the
+        # client or we added to the request
+        toret = dict((k, v) for (k, v) in environ.iteritems()
+                     if not (k.startswith('HTTP_IF_') or
+                             k.startswith('dropboxwsgi.') or
+                             k in ('HTTP_RANGE', 'HTTP_ACCEPT_ENCODING')))
+        toret.update({'REQUEST_METHOD': 'GET',
+                      'wsgi.input': io.BytesIO()})
+        toret.update(extra)
+        return toret
+
     def wrapper(app):
+        def revalidate(environ):
+            path = environ['PATH_INFO']
+            with revalidating_lock:
+                if path in revalidating:
+                    return
+                revalidating.add(path)
+
+            bg_environ = sub_environ(environ, **{'dropboxwsgi.revalidate': True})
+
+            def run():
+                try:
+                    res = new_app(bg_environ, lambda code, headers, exc_info=None: (lambda data: None))
+                    try:
+                        # new data is saved as it is read
+                        for _ in res:
+                            pass
+                    finally:
+                        if hasattr(res, 'close'):
+                            res.close()
+                except Exception:
+                    logger.exception("Couldn't revalidate %r", path)
+                finally:
+                    with revalidating_lock:
+                        revalidating.discard(path)
+
+            t = threading.Thread(target=run)
+            t.daemon = True
+            t.start()
+
+        def fresh_not_modified(environ, start_response):
+            # the client's copy is the one we know to be current
+            if (not use_freshness or
+                'HTTP_IF_NONE_MATCH' not in environ or
+                'HTTP_IF_MATCH' in environ):
+                return None
+
+            path = environ['PATH_INFO']
+            age = cached_age(path)
+            if age is None or age >= max_age:
+                return None
+
+            try:
+                h = impl.read_cached_headers(path)
+            except Exception:
+                return None
+
+            etag = get_from_alist(h, 'etag', key=methodcaller('lower'))
+            for client_etag in environ['HTTP_IF_NONE_MATCH'].split(','):
+                client_etag = client_etag.strip()
+                if etag is not None and strip_variant_etag(client_etag) == etag:
+                    break
+            else:
+                return None
+
+            logger.debug("Fresh cache hit, not modified: %r", path)
+            record(environ, 'not_modified')
+            start_response('304 NOT MODIFIED',
+                           [('ETag', client_etag), ('Age', str(int(age)))] +
+                           [(k, v) for (k, v) in h if k.lower() == 'last-modified'])
+            return []
+
         def new_app(environ, start_response):
+            method = environ['REQUEST_METHOD'].upper()
+
+            if method not in ('GET', 'HEAD'):
+                record(environ, 'bypass')
+                return app(environ, start_response)
+
             # if the client is already sending up
             # the caching headers then use that
             if ('HTTP_IF_MODIFIED_SINCE' in environ or
                 'HTTP_IF_NONE_MATCH' in environ):
+                toret = fresh_not_modified(environ, start_response)
+                if toret is not None:
+                    return toret
+                record(environ, 'bypass')
                 return app(environ, start_response)
 
+            is_head = method == 'HEAD'
+
             path = environ['PATH_INFO']
 
+            # we choose the content-coding ourselves (if at all), the
+            # app only ever gives us the identity encoding to save
+            accept_encoding = environ.pop('HTTP_ACCEPT_ENCODING', None)
+            encoding = None
+            if compress and 'HTTP_RANGE' not in environ:
+                encoding = negotiate(accept_encoding)
+
+            h = None
+            injected = []
             try:
-                h = impl.read_cached_headers(path)
+                with timed(environ, 'cache-lookup'):
+                    h = impl.read_cached_headers(path)
             except Exception, e:
                 if not (isinstance(e, EnvironmentError) and e.errno == errno.ENOENT):
                     logger.exception("Couldn't read cached data")
@@ -197,73 +1365,293 @@ def make_caching(impl):
                 etag = get_from_alist(h, 'etag', key=methodcaller('lower'))
                 if etag is not None:
                     environ['HTTP_IF_NONE_MATCH'] = etag
+                    injected.append('HTTP_IF_NONE_MATCH')
 
                 last_modified = get_from_alist(h, 'last-modified', key=methodcaller('lower'))
                 if last_modified is not None:
                     environ['HTTP_IF_MODIFIED_SINCE'] = last_modified
+                    injected.append('HTTP_IF_MODIFIED_SINCE')
 
                 logger.debug("for %r, etag: %r, last-modified: %r", path, etag, last_modified)
 
-            writer = [None]
+            def retry():
+                # try again without waiting on anyone this time
+                for k in injected:
+                    del environ[k]
+                environ.pop('dropboxwsgi.should_fetch', None)
+                environ['dropboxwsgi.fill_retry'] = True
+                if accept_encoding is not None:
+                    environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+                return new_app(environ, start_response)
+
+            def serve_cached(h):
+                try:
+                    if should_encode(h, encoding):
+                        return serve_variant(environ, start_response, path, h,
+                                             encoding, is_head)
+
+                    if is_head:
+                        # the saved headers are all we need
+                        start_response('200 OK', h)
+                        return []
+
+                    # send out locally saved data
+                    with timed(environ, 'cache-open'):
+                        f = impl.read_cached_data(path)
+                except EnvironmentError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # evicted since we read the headers, fetch it again
+                    logger.debug("Cached data went away: %r", path)
+                    if hasattr(impl, 'drop_cached_data'):
+                        impl.drop_cached_data(path)
+                    environ.pop('dropboxwsgi.cache_variant', None)
+                    return retry()
+                return serve_data(environ, start_response, h, f,
+                                  environ.get('wsgi.file_wrapper', FileWrapper))
+
+            age = None
+            if h is not None and use_freshness:
+                with timed(environ, 'cache-age'):
+                    age = cached_age(path)
+
+            if age is not None and not environ.get('dropboxwsgi.revalidate'):
+                if age < max_age:
+                    logger.debug("Fresh cache hit: %r", path)
+                    record(environ, 'fresh')
+                    return serve_cached(h + [('Age', str(int(age)))])
+
+                if age < max_age + stale_while_revalidate:
+                    logger.debug("Stale cache hit, revalidating: %r", path)
+                    record(environ, 'stale')
+                    revalidate(environ)
+                    return serve_cached(h + [('Age', str(int(age))),
+                                             ('Warning', '110 - "Response is Stale"')])
+
+            # whether we can fall back to the cached data if the app fails
+            stale_on_error = age is not None and age < max_age + stale_if_error
+
+            # the fill this request is responsible for, or the one
+            # it is waiting on
+            own_fill = [None]
+            follow = [None]
+            link = [False]
+            def should_fetch(current_etag):
+                # we might have this data under another path already
+                has_etag = getattr(impl, 'has_etag', None)
+                if has_etag is not None and has_etag(path, current_etag):
+                    link[0] = True
+                    return False
+
+                with fills_lock:
+                    fill = fills.get(path)
+                    if fill is None or fill.state == _Fill.FAILED:
+                        if 'HTTP_RANGE' in environ:
+                            # we won't be saving a partial response
+                            return True
+                        fill = fills[path] = own_fill[0] = _Fill(current_etag)
+                        return True
+                    elif fill.etag == current_etag:
+                        follow[0] = fill
+                        return False
+                    else:
+                        # a fill for another version is still running,
+                        # don't bother waiting on it
+                        return True
+
+            if not environ.get('dropboxwsgi.fill_retry'):
+                environ['dropboxwsgi.should_fetch'] = should_fetch
+
+            job = [None]
             def make_writer(headers):
                 f = impl.write_cached_data(path, headers)
+                fill = own_fill[0]
                 try:
+                    if fill is not None:
+                        fill.start(headers, f)
                     while True:
                         data = yield
                         if not data:
                             break
                         f.write(data)
-                    f.done()
+                        if fill is not None:
+                            fill.wrote(len(data))
+                    if fill is not None:
+                        fill.commit(f.done)
+                    else:
+                        f.done()
                 finally:
                     f.close()
 
             top_res = []
+            encode = [False]
             def my_start_response(code, headers):
-                top_res[:] = [code]
-                if code.startswith('304'):
+                top_res[:] = [code, headers]
+                if code.startswith('304') or (stale_on_error and code.startswith('5')):
                     def noop(_): pass
                     return noop
                 else:
+                    out_headers = headers
+                    if code.startswith('200') and should_encode(headers, encoding):
+                        out_headers = encoded_headers(headers, encoding)
+                        encode[0] = True
+
                     etag = None
-                    if code.startswith('200'):
+                    # HEAD responses have no body to save
+                    if (code.startswith('200') and not is_head and
+                        get_from_alist(headers, 'content-encoding',
+                                       methodcaller('lower')) is None):
                         # save new data with etag if it exists
                         etag = get_from_alist(headers, 'etag', methodcaller('lower'))
 
                     if etag is not None:
                         # they are going to pass data into this thing,
                         # save it!!
-                        top_writer = start_response(code, headers)
-                        writer[0] = make_writer(headers)
-                        writer[0].next()
+                        top_writer = start_response(code, out_headers)
+                        fill = own_fill[0]
+                        def finish(ok):
+                            if fill is not None:
+                                release(path, fill, ok)
+                        job[0] = _FillJob(path, make_writer(headers), finish)
 
                         def new_writer(data):
-                            writer[0].send(data)
+                            fill_writer.write(job[0], data)
                             return top_writer(data)
 
                         return new_writer
                     else:
-                        return start_response(code, headers)
+                        return start_response(code, out_headers)
+
+            try:
+                res = app(environ, my_start_response)
+            except Exception:
+                if own_fill[0] is not None:
+                    release(path, own_fill[0], False)
+                if not stale_on_error:
+                    raise
+                logger.exception("App failed, serving stale cached data: %r", path)
+                record(environ, 'stale_error')
+                return serve_cached(h + [('Warning', '111 - "Revalidation Failed"')])
+
+            if stale_on_error and top_res[0].startswith('5'):
+                logger.warning("Got %r, serving stale cached data: %r", top_res[0], path)
+                record(environ, 'stale_error')
+                if hasattr(res, 'close'):
+                    res.close()
+                return serve_cached(h + [('Warning', '111 - "Revalidation Failed"')])
+
+            if own_fill[0] is not None and job[0] is None:
+                # we didn't end up fetching anything after all
+                release(path, own_fill[0], False)
+
+            if top_res[0].startswith('304') and link[0]:
+                try:
+                    impl.link_cached_data(path, top_res[1])
+                    h = impl.read_cached_headers(path)
+                except Exception:
+                    logger.exception("Couldn't link to cached data")
+                    return retry()
+                logger.debug("Linked to cached data: %r", path)
+
+            if top_res[0].startswith('304') and follow[0] is not None:
+                fill = follow[0]
+                def resume(offset):
+                    # fetch the rest ourselves, like we would have
+                    # if there had been nobody to follow
+                    status = []
+                    def sr(code, headers, exc_info=None):
+                        status[:] = [code]
+                        return lambda data: None
+                    res = app(sub_environ(environ, HTTP_RANGE='bytes=%d-' % offset,
+                                          HTTP_IF_MATCH=fill.etag), sr)
+                    if not status[0].startswith('206'):
+                        if hasattr(res, 'close'):
+                            res.close()
+                        raise Exception("Couldn't resume failed cache fill: %s" % status[0])
+                    return res
+                (state, fill_headers, reader) = fill.open(resume)
+                if state == _Fill.STREAMING:
+                    logger.debug("Joining cache fill: %r", path)
+                    record(environ, 'follow')
+                    if should_encode(fill_headers, encoding):
+                        start_response('200 OK', encoded_headers(fill_headers, encoding))
+                        return compress_stream(encoding, FileWrapper(reader, block_size))
+                    return serve_data(environ, start_response, fill_headers,
+                                      reader, FileWrapper)
+
+                if state == _Fill.DONE:
+                    try:
+                        h = impl.read_cached_headers(path)
+                    except Exception:
+                        logger.exception("Couldn't read cached data")
+                        h = None
+
+                if (h is None or
+                    get_from_alist(h, 'etag', key=methodcaller('lower')) != fill.etag):
+                    # the fill we were waiting on didn't work out
+                    logger.debug("Cache fill failed, retrying: %r", path)
+                    return retry()
 
-            res = app(environ, my_start_response)
             if top_res[0].startswith('304'):
                 logger.debug("Cache hit: %r", path)
-                # send out locally saved data
-                start_response('200 OK', h)
-                fwrapper = environ.get('wsgi.file_wrapper', FileWrapper)
-                block_size = 16 * 1024
-                toret = fwrapper(impl.read_cached_data(path), block_size)
-            elif writer[0] is not None:
+                record(environ, 'link' if link[0] else
+                       'follow' if follow[0] is not None else 'hit')
+                if use_freshness and injected and not link[0] and follow[0] is None:
+                    # the app just told us our copy is current
+                    mark_validated(path)
+
+                if environ.get('dropboxwsgi.revalidate'):
+                    return []
+
+                toret = serve_cached(h)
+            elif job[0] is not None:
                 logger.debug("Cache miss: %r", path)
+                record(environ, 'miss')
                 # handle the rest of data for saving
+                length = get_from_alist(top_res[1], 'content-length',
+                                        key=methodcaller('lower'))
                 def better_res():
-                    for d in res:
-                        writer[0].send(d)
-                        yield d
-                    writer[0].send('')
-                toret = better_res()
+                    ok = False
+                    handed_off = False
+                    sent = 0
+                    it = iter(res)
+                    try:
+                        for d in it:
+                            fill_writer.write(job[0], d)
+                            sent += len(d)
+                            yield d
+                        fill_writer.close(job[0])
+                        ok = True
+                    except GeneratorExit:
+                        # the client went away
+                        if length is not None and int(length) - sent <= finish_fill_bytes:
+                            logger.debug("Client went away, finishing cache fill: %r", path)
+                            finish_fill(path, job[0], it, res, int(length) - sent)
+                            handed_off = True
+                            return
+                        cache_fills_dropped.inc(1, 'disconnect')
+                        raise
+                    finally:
+                        if not handed_off:
+                            if hasattr(res, 'close'):
+                                res.close()
+                            if not ok:
+                                fill_writer.abandon(job[0])
+
+                def close_unstarted():
+                    try:
+                        if hasattr(res, 'close'):
+                            res.close()
+                    finally:
+                        fill_writer.abandon(job[0])
+                toret = ClosingIterator(better_res(), close_unstarted)
             else:
+                record(environ, 'uncached')
                 toret = res
 
+            if encode[0] and not is_head:
+                toret = compress_stream(encoding, toret)
+
             return toret
         return new_app
     return wrapper
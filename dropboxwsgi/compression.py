@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .util import ClosingIterator
+
+# content types worth compressing besides text/*
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/x-font-ttf',
+    'application/vnd.ms-fontobject',
+    'image/svg+xml',
+    'image/x-icon',
+])
+
+# not worth the trouble below this many bytes
+MIN_SIZE = 256
+
+# every encoding we know about, in order of preference
+ALL_ENCODINGS = ('br', 'gzip')
+
+# the ones we can actually produce
+ENCODINGS = tuple(e for e in ALL_ENCODINGS if e != 'br' or brotli is not None)
+
+def is_compressible(content_type, length=None):
+    if length is not None and length < MIN_SIZE:
+        return False
+    ct = content_type.split(';', 1)[0].strip().lower()
+    return (ct.startswith('text/') or
+            ct in COMPRESSIBLE_TYPES or
+            ct.endswith('+xml') or
+            ct.endswith('+json'))
+
+def negotiate(accept_encoding, available=ENCODINGS):
+    """
+    Picks the best of the `available` encodings given the value of an
+    Accept-Encoding header, returns None if the client should get the
+    identity encoding.
+    """
+    if not accept_encoding:
+        return None
+
+    qvalues = {}
+    for part in accept_encoding.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            (k, _, v) = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+
+    best = None
+    for coding in available:
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+
+    return best and best[0]
+
+def variant_etag(etag, encoding):
+    # "_<rev>" -> "_<rev>-gzip"
+    return '%s-%s"' % (etag[:-1], encoding)
+
+def strip_variant_etag(etag):
+    if etag.endswith('"'):
+        for encoding in ALL_ENCODINGS:
+            suffix = '-%s"' % encoding
+            if etag.endswith(suffix):
+                return etag[:-len(suffix)] + '"'
+    return etag
+
+def encoded_headers(headers, encoding, length=None):
+    """
+    Turns the headers of an identity response into those of the
+    `encoding`-encoded variant, `length` is its size if known.
+    """
+    toret = []
+    for (k, v) in headers:
+        kl = k.lower()
+        if kl == 'content-length' or kl == 'vary':
+            continue
+        elif kl == 'etag':
+            v = variant_etag(v, encoding)
+        elif kl == 'accept-ranges':
+            # ranges are only served for the identity encoding
+            continue
+        toret.append((k, v))
+    toret.append(('Content-Encoding', encoding))
+    toret.append(('Vary', 'Accept-Encoding'))
+    if length is not None:
+        toret.append(('Content-Length', str(length)))
+    return toret
+
+def gzip_stream(iterable, level=6):
+    co = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for data in iterable:
+        out = co.compress(data)
+        if out:
+            yield out
+    yield co.flush()
+
+def brotli_stream(iterable, quality=5):
+    co = brotli.Compressor(quality=quality)
+    for data in iterable:
+        out = co.process(data)
+        if out:
+            yield out
+    yield co.finish()
+
+def compress_stream(encoding, iterable):
+    """
+    Compresses `iterable` as it is iterated over, never holding more
+    than one chunk of it in memory.
+    """
+    if encoding == 'gzip':
+        gen = gzip_stream(iterable)
+    elif encoding == 'br':
+        gen = brotli_stream(iterable)
+    else:
+        raise ValueError("Unknown encoding: %r" % encoding)
+
+    def close():
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+    def stream():
+        try:
+            for data in gen:
+                yield data
+        finally:
+            close()
+
+    return ClosingIterator(stream(), close)
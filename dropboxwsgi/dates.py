@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Parsing and formatting of the fixed-format dates we deal with on
+every request: Dropbox API dates ("Sat, 21 Aug 2010 22:31:20 +0000")
+and HTTP dates. The common formats are handled by hand, which is
+several times faster than strptime()/strftime(), anything else falls
+back to strptime(). Results are memoized since the same few dates
+come up over and over.
+"""
+
+import calendar
+import time
+
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_MONTHS = dict((name, i + 1) for (i, name) in enumerate(MONTH_NAMES))
+
+# number of results each memo keeps before starting over
+MEMO_SIZE = 4096
+
+def _memoized(fn):
+    memo = {}
+    def new_fn(arg):
+        toret = memo.get(arg)
+        if toret is not None:
+            return toret
+        toret = fn(arg)
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[arg] = toret
+        return toret
+    new_fn.memo = memo
+    new_fn.__name__ = fn.__name__
+    new_fn.__doc__ = fn.__doc__
+    return new_fn
+
+def _days_from_civil(y, m, d):
+    # days since 1970-01-01 of a proleptic gregorian date
+    if m <= 2:
+        y -= 1
+    era = (y if y >= 0 else y - 399) // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def _to_posix(year, month_name, day, hms):
+    # raises ValueError (or KeyError for a bad month) on anything odd
+    month = _MONTHS[month_name]
+    (hours, minutes, seconds) = hms.split(':')
+    (year, day, hours, minutes, seconds) = (int(year), int(day), int(hours),
+                                            int(minutes), int(seconds))
+    if not (1 <= day <= 31 and 0 <= hours <= 23 and
+            0 <= minutes <= 59 and 0 <= seconds <= 61):
+        raise ValueError("Bad date")
+    return (_days_from_civil(year, month, day) * 86400 +
+            hours * 3600 + minutes * 60 + seconds)
+
+def tz_offset(tz_string):
+    factor = 1 if tz_string[0] == '+' else -1
+    hours = 3600 * int(tz_string[1:3])
+    minutes = 60 * int(tz_string[3:5])
+    return factor * (hours + minutes)
+
+@_memoized
+def dropbox_date_to_posix(date_string):
+    fmt_date, tz = date_string.rsplit(' ', 1)
+    try:
+        # "Sat, 21 Aug 2010 22:31:20"
+        (_, day, month_name, year, hms) = fmt_date.split(' ')
+        ts = _to_posix(year, month_name, day, hms)
+    except (ValueError, KeyError):
+        ts = calendar.timegm(time.strptime(fmt_date, "%a, %d %b %Y %H:%M:%S"))
+    return ts + tz_offset(tz)
+
+@_memoized
+def _format_http_date(ts):
+    # strftime() is the fastest way to format the numbers, but
+    # it would use the locale's day and month names
+    tt = time.gmtime(ts)
+    return (time.strftime('%%s, %d %%s %Y %H:%M:%S GMT', tt) %
+            (DAY_NAMES[tt[6]], MONTH_NAMES[tt[1] - 1]))
+
+def posix_to_http_date(ts=None):
+    if ts is None:
+        ts = time.time()
+    return _format_http_date(int(ts // 1))
+
+@_memoized
+def posix_to_listing_date(ts):
+    """
+    Formats `ts` like strftime("%Y-%b-%d %H:%M:%S") would, for
+    directory listings.
+    """
+    tt = time.gmtime(ts)
+    return time.strftime('%Y-%%s-%d %H:%M:%S', tt) % MONTH_NAMES[tt[1] - 1]
+
+@_memoized
+def http_date_to_posix(date_string):
+    # parse date string in three different formats
+    # 1) Sun, 06 Nov 1994 08:49:37 GMT  ; RFC 822, updated by RFC 1123
+    # 2) Sunday, 06-Nov-94 08:49:37 GMT ; RFC 850, obsoleted by RFC 1036
+    # 3) Sun Nov  6 08:49:37 1994       ; ANSI C's asctime() format
+    # the first one is by far the most common, so it's done by hand
+    pieces = date_string.split(' ')
+    if len(pieces) == 6 and pieces[5] == 'GMT':
+        try:
+            return _to_posix(pieces[3], pieces[2], pieces[1], pieces[4])
+        except (ValueError, KeyError):
+            pass
+
+    for fmt in ["%a, %d %b %Y %H:%M:%S GMT",
+                "%A, %d-%b-%y %H:%M:%S GMT",
+                "%a %b %d %H:%M:%S %Y"]:
+        try:
+            _tt = time.strptime(date_string, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(_tt)
+    else:
+        raise ValueError("Date could not be parsed")
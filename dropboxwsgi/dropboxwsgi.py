@@ -24,14 +24,12 @@
 
 from __future__ import absolute_import
 
-import calendar
 import errno
 import logging
 import os
 import pprint
 import sys
 import tempfile
-import time
 import traceback
 import urllib
 
@@ -49,47 +47,23 @@ import dropbox
 from dropbox.rest import ErrorResponse
 
 from .six import b, r
+from .dates import (dropbox_date_to_posix, http_date_to_posix,
+                    posix_to_http_date, posix_to_listing_date)
+from .backends import BackendError
+from .compression import (compress_stream, encoded_headers, is_compressible,
+                          negotiate, strip_variant_etag)
+from .namespace import NamespaceIndex, NamespaceSyncer
+from .pool import ClientPool, PooledClient
+from .ranges import range_response, requested_ranges
+from .timing import timed
+from .util import LRUCache, SingleFlight
 from ._version import __version__
 
-# TODO: Range Requests (need to extend Dropbox SDK)
-# TODO: HEAD/PUT/POST Requests
+# TODO: PUT/POST Requests
 # TODO: Support index.html-like files
 
 logger = logging.getLogger(__name__)
 
-def tz_offset(tz_string):
-    factor = 1 if tz_string[0] == '+' else -1
-    hours = 3600 * int(tz_string[1:3])
-    minutes = 60 * int(tz_string[3:5])
-    return factor * (hours + minutes)
-
-def dropbox_date_to_posix(date_string):
-    fmt_date, tz = date_string.rsplit(' ', 1)
-    ts = calendar.timegm(time.strptime(fmt_date, "%a, %d %b %Y %H:%M:%S"))
-    return ts + tz_offset(tz)
-
-def posix_to_http_date(ts=None):
-    if ts is None:
-        ts = time.time()
-    HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
-    return time.strftime(HTTP_DATE_FORMAT, time.gmtime(ts))
-
-def http_date_to_posix(date_string):
-    # parse date string in three different formats
-    # 1) Sun, 06 Nov 1994 08:49:37 GMT  ; RFC 822, updated by RFC 1123
-    # 2) Sunday, 06-Nov-94 08:49:37 GMT ; RFC 850, obsoleted by RFC 1036
-    # 3) Sun Nov  6 08:49:37 1994       ; ANSI C's asctime() format
-    for fmt in ["%a, %d %b %Y %H:%M:%S GMT",
-                "%A, %d-%b-%y %H:%M:%S GMT",
-                "%a %b %d %H:%M:%S %Y"]:
-        try:
-            _tt = time.strptime(date_string, fmt)
-        except ValueError:
-            continue
-        return calendar.timegm(_tt)
-    else:
-        raise ValueError("Date could not be parsed")
-
 MATCH_ANY = object()
 def get_match(environ, key_name):
     try:
@@ -100,7 +74,21 @@ def get_match(environ, key_name):
         if if_none_match.strip() == "*":
             return MATCH_ANY
         else:
-            return [a.strip() for a in if_none_match.split(',')]
+            # compressed variants share the identity encoding's validators
+            return [strip_variant_etag(a.strip()) for a in if_none_match.split(',')]
+
+def decode_path(path):
+    # PATH_INFO is bytes smuggled through latin1 on python 3
+    if sys.version_info >= (3,):
+        path = path.encode('latin1')
+
+    # turn path into unicode
+    for enc in ['utf8', 'latin1']:
+        try:
+            return path.decode(enc)
+        except UnicodeDecodeError:
+            pass
+    return None
 
 # it's nice to have this as a separate function
 HTTP_PRECONDITION_FAILED = 412
@@ -140,6 +128,7 @@ def http_cache_logic(current_etag, current_modified_date,
 class FileSystemCredStorage(object):
     def __init__(self, app_dir):
         self.access_token_path = os.path.join(app_dir, 'access_token')
+        self.namespace_state_path = os.path.join(app_dir, 'namespace_state')
 
     def read_access_token(self):
         # TODO: check validity of data stored in file
@@ -151,9 +140,25 @@ class FileSystemCredStorage(object):
         with open(self.access_token_path, 'w') as f:
             json.dump((key, secret), f)
 
+    def read_namespace_state(self):
+        with open(self.namespace_state_path, 'r') as f:
+            return json.load(f)
+
+    def write_namespace_state(self, state):
+        # the state can be big, never leave a half-written file around
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.namespace_state_path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.namespace_state_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
 class MemoryCredStorage(object):
     def __init__(self):
         self._token = None
+        self._namespace_state = None
 
     def read_access_token(self):
         if self._token is None:
@@ -163,6 +168,14 @@ class MemoryCredStorage(object):
     def write_access_token(self, key, secret):
         self._token = (key, secret)
 
+    def read_namespace_state(self):
+        if self._namespace_state is None:
+            raise Exception("No Namespace State!")
+        return self._namespace_state
+
+    def write_namespace_state(self, state):
+        self._namespace_state = state
+
 def _make_server_tag(environ):
     ss = environ.get('SERVER_SOFTWARE', '')
     if ss:
@@ -216,9 +229,10 @@ div.foot { font: 90%% monospace; color: #787878; padding-top: 4px;}
         yield b('<td class="t">Directory</td>\n')
         yield b('</tr>\n')
 
-    # Show directories first
-    md['contents'].sort(key=lambda ent: (not ent['is_dir'], ent['path']))
-    for entry in md['contents']:
+    # Show directories first, don't sort in place since `md` may be
+    # shared with other requests through the metadata cache
+    for entry in sorted(md['contents'],
+                        key=lambda ent: (not ent['is_dir'], ent['path'])):
         path = entry['path']
         name = path.rsplit(u'/', 1)[1]
         trail = u"/" if entry['is_dir'] else u""
@@ -226,7 +240,7 @@ div.foot { font: 90%% monospace; color: #787878; padding-top: 4px;}
         yield (u'<td class="n"><a href="%s%s">%s</a>%s</td>\n'
                % (name, trail, name, trail)).encode('utf8')
         yield (u'<td class="m">%s</td>\n'
-               % time.strftime(u"%Y-%b-%d %H:%M:%S", time.gmtime(dropbox_date_to_posix(r(entry['modified']))))).encode('utf8')
+               % posix_to_listing_date(dropbox_date_to_posix(r(entry['modified'])))).encode('utf8')
         yield (u'<td class="s">%s</td>\n'
                % (u'- &nbsp;'
                   if entry['is_dir'] else
@@ -247,11 +261,41 @@ div.foot { font: 90%% monospace; color: #787878; padding-top: 4px;}
 
     yield toyield
 
-def make_app(config, impl):
+class _ResponseBody(object):
+    # unlike a generator, this closes `res` even if it is
+    # closed before iteration starts
+    def __init__(self, res, block_size):
+        self.res = res
+        self.block_size = block_size
+
+    def __iter__(self):
+        try:
+            while True:
+                ret = self.res.read(self.block_size)
+                if not ret:
+                    break
+                yield ret
+        finally:
+            self.close()
+
+    def close(self):
+        if self.res is not None:
+            res = self.res
+            self.res = None
+            res.close()
+
+def _compressed(app, encoding):
+    def new_app(environ, start_response):
+        return compress_stream(encoding, app(environ, start_response))
+    return new_app
+
+def make_app(config, impl, backend=None):
+    # `backend` replaces the Dropbox API, see dropboxwsgi.backends
     http_root = config['http_root']
     finish_link_path = '/finish_link'
     block_size = 16 * 1024
     allow_directory_listing = config.get('allow_directory_listing', True)
+    compress = config.get('enable_compression', False)
 
     index_file_list = config.get('index_file_names')
     if index_file_list:
@@ -265,20 +309,140 @@ def make_app(config, impl):
     else:
         find_index_file = None
 
-    sess = dropbox.session.DropboxSession(config['consumer_key'],
-                                          config['consumer_secret'],
-                                          config['access_type'])
+    sess = dropbox.session.DropboxSession(config.get('consumer_key'),
+                                          config.get('consumer_secret'),
+                                          config.get('access_type'))
 
-    # get token
-    try:
-        at = impl.read_access_token()
-    except Exception:
-        # TODO check exception type
-        traceback.print_exc()
+    if backend is not None:
+        # nothing to link
+        is_linked = lambda: True
+    else:
+        is_linked = sess.is_linked
+
+        # get token
+        try:
+            at = impl.read_access_token()
+        except Exception:
+            # TODO check exception type
+            traceback.print_exc()
+        else:
+            sess.set_token(*at)
+
+    def make_client():
+        if backend is not None:
+            return backend
+        try:
+            # SDKs since 1.5 keep their connection open in a RESTClientObject
+            rest_client = dropbox.rest.RESTClientObject(max_reusable_connections=1)
+        except AttributeError:
+            # older ones open a new connection per request anyway
+            return dropbox.client.DropboxClient(sess)
+        return dropbox.client.DropboxClient(sess, rest_client=rest_client)
+
+    client_pool = ClientPool(make_client, config.get('client_pool_size', 8),
+                             config.get('client_pool_timeout', 30))
+    client = PooledClient(client_pool)
+
+    metadata_cache_size = config.get('metadata_cache_size', 0)
+    metadata_cache_ttl = config.get('metadata_cache_ttl', 0)
+    if metadata_cache_size and metadata_cache_ttl:
+        metadata_cache = LRUCache(metadata_cache_size, metadata_cache_ttl)
+    else:
+        metadata_cache = None
+
+    if config.get('enable_namespace_sync'):
+        namespace = NamespaceIndex()
+        NamespaceSyncer(client, namespace, impl, is_linked,
+                        config.get('namespace_sync_interval', 30),
+                        config.get('namespace_save_interval', 300)).start()
     else:
-        sess.set_token(*at)
+        namespace = None
 
-    client = dropbox.client.DropboxClient(sess)
+    listing_cache_size = config.get('listing_cache_size', 0)
+    if listing_cache_size:
+        listing_cache = LRUCache(listing_cache_size)
+    else:
+        listing_cache = None
+
+    negative_cache_size = config.get('negative_cache_size', 0)
+    negative_cache_ttl = config.get('negative_cache_ttl', 0)
+    if negative_cache_size and negative_cache_ttl:
+        # lower-cased path -> hash of its parent folder when it was missing
+        negative_cache = LRUCache(negative_cache_size, negative_cache_ttl)
+        # lower-cased folder path -> the last hash we saw for it
+        folder_hashes = LRUCache(negative_cache_size)
+    else:
+        negative_cache = None
+
+    def _parent(path):
+        return path.rstrip(u'/').rsplit(u'/', 1)[0] or u'/'
+
+    def is_known_missing(path):
+        if negative_cache is None or (namespace is not None and namespace.ready):
+            # a namespace lookup is just as cheap, and never out of date
+            return False
+        key = path.lower()
+        parent_hash = negative_cache.get(key, False)
+        if parent_hash is False:
+            return False
+        current_hash = folder_hashes.get(_parent(key))
+        if current_hash is not None and current_hash != parent_hash:
+            # something changed in the parent folder since
+            negative_cache.pop(key)
+            return False
+        return True
+
+    def remember_missing(path):
+        if negative_cache is not None:
+            key = path.lower()
+            negative_cache.set(key, folder_hashes.get(_parent(key)))
+
+    inflight_metadata = SingleFlight()
+
+    def get_metadata(path, list_, **kw):
+        # `kw` only carries the directory hash, a cached entry
+        # is just as good since http_cache_logic() will compare
+        # it against the ETag anyway
+        if namespace is not None and namespace.ready:
+            return namespace.metadata(path, list_)
+
+        key = (path, list_)
+        if metadata_cache is not None:
+            md = metadata_cache.get(key)
+            if md is not None:
+                return md
+
+        # concurrent requests for the same path share one API call
+        md = inflight_metadata.do((path, list_, tuple(sorted(kw.items()))),
+                                  client.metadata, path, list=list_, **kw)
+
+        if metadata_cache is not None:
+            metadata_cache.set(key, md)
+
+        if negative_cache is not None and md.get('is_dir') and 'hash' in md:
+            folder_hashes.set(md['path'].rstrip(u'/').lower() or u'/', md['hash'])
+
+        return md
+
+    def render_listing(environ, md, encoding):
+        # a listing only changes with the folder hash (and the server
+        # tag in its footer), so unchanged folders are rendered once
+        key = (md['path'], md['hash'], _make_server_tag(environ))
+        variants = None
+        if listing_cache is not None:
+            variants = listing_cache.get(key)
+
+        if variants is None:
+            variants = {None: b('').join(_render_directory_contents(environ, md))}
+            if listing_cache is not None:
+                listing_cache.set(key, variants)
+
+        try:
+            return variants[encoding]
+        except KeyError:
+            body = b('').join(compress_stream(encoding, [variants[None]]))
+            variants[encoding] = body
+            return body
 
     def link_app(environ, start_response):
         # this is the pingback
@@ -317,8 +481,8 @@ def make_app(config, impl):
         start_response('502 BAD GATEWAY', [('Content-type', 'text/plain')])
         return [b('Bad Gateway!')]
 
-    def not_modified_response(environ, start_response):
-        start_response('304 NOT MODIFIED', [])
+    def not_modified_response(environ, start_response, headers=()):
+        start_response('304 NOT MODIFIED', list(headers))
         return []
 
     def precondition_failed_response(environ, start_response):
@@ -336,29 +500,23 @@ def make_app(config, impl):
     @add_server_tag
     def app(environ, start_response):
         # TODO: support other request methods
-        if environ['REQUEST_METHOD'].upper() != 'GET':
+        method = environ['REQUEST_METHOD'].upper()
+        if method not in ('GET', 'HEAD'):
             start_response('405 METHOD NOT ALLOWED', [('Content-type', 'text/plain'),
-                                                      ('Allow', 'GET')])
+                                                      ('Allow', 'GET, HEAD')])
             return [b('Method Not Allowed!')]
+        is_head = method == 'HEAD'
 
         # checked if we are linked yet
-        if not sess.is_linked():
+        if not is_linked():
             return link_app(environ, start_response)
 
         path = environ['PATH_INFO']
 
-        if sys.version_info >= (3,):
-            path = path.encode('latin1')
+        with timed(environ, 'decode'):
+            path = decode_path(path)
 
-        # turn path into unicode
-        for enc in ['utf8', 'latin1']:
-            try:
-                path = path.decode(enc)
-            except UnicodeDecodeError:
-                pass
-            else:
-                break
-        else:
+        if path is None:
             return not_found_response(environ, start_response)
 
         if_match = get_match(environ, 'HTTP_IF_MATCH')
@@ -381,15 +539,22 @@ def make_app(config, impl):
                        (find_index_file or
                         allow_directory_listing))
 
+        if is_known_missing(path):
+            logging.debug("Known to be missing: %r", path)
+            return not_found_response(environ, start_response)
+
         try:
-            md = client.metadata(path, list=should_list, **kw)
+            with timed(environ, 'metadata'):
+                md = get_metadata(path, should_list, **kw)
         except Exception, e:
-            if (isinstance(e, ErrorResponse) and
+            if (isinstance(e, (ErrorResponse, BackendError)) and
                 (e.status in (304, 404))):
                 if e.status == 304:
-                    return not_modified_response(environ, start_response)
+                    return not_modified_response(environ, start_response,
+                                                 [('ETag', if_none_match[0])])
                 elif e.status == 404:
                     logging.debug("API error says not found: %r", path)
+                    remember_missing(path)
                     return not_found_response(environ, start_response)
             else:
                 logger.exception("API Error")
@@ -398,6 +563,7 @@ def make_app(config, impl):
         if md.get('is_deleted'):
             # if the file is deleted just cancel early
             logging.debug("File is deleted: %r", path)
+            remember_missing(path)
             return not_found_response(environ, start_response)
 
         if md['is_dir'] and path[-1] != u"/":
@@ -412,7 +578,8 @@ def make_app(config, impl):
             index_file = find_index_file(md['contents'])
             if index_file is not None:
                 try:
-                    md2 = client.metadata(index_file, list=False)
+                    with timed(environ, 'index'):
+                        md2 = get_metadata(index_file, False)
                 except Exception:
                     logger.exception("Exception while trying to get index file")
                 else:
@@ -437,39 +604,71 @@ def make_app(config, impl):
             # we could use include_deleted and use max(ent['modified']) of all
             # children but the 10000 entry limit scares me when including deleted files
             current_modified_date = None
+            headers = [('Content-type', 'text/html; charset=utf-8'),
+                       ('Cache-Control', 'public, no-cache'),
+                       ('ETag', current_etag)]
             def directory_response(environ, start_response):
-                start_response('200 OK', [('Content-type', 'text/html; charset=utf-8'),
-                                          ('Cache-Control', 'public, no-cache'),
-                                          ('ETag', current_etag)])
-                return _render_directory_contents(environ, md)
+                # HEAD renders it too (usually from the listing cache)
+                # so its Content-Length matches the GET
+                with timed(environ, 'listing'):
+                    body = render_listing(environ, md, encoding)
+                start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+                if is_head:
+                    return []
+                return [body]
 
             toret = directory_response
         else:
             current_etag = r(u'"_%s"' % md['rev'])
             current_modified_date = dropbox_date_to_posix(r(md['modified']))
+            last_modified_date = posix_to_http_date(current_modified_date)
+            headers = [('Content-Type', r(md['mime_type'])),
+                       ('Cache-Control', 'public, no-cache'),
+                       ('Content-Length', str(md['bytes'])),
+                       ('Accept-Ranges', 'bytes'),
+                       ('ETag', current_etag),
+                       ('Last-Modified', last_modified_date)]
             def file_response(environ, start_response):
-                last_modified_date = posix_to_http_date(current_modified_date)
-                start_response('200 OK', [('Content-Type', r(md['mime_type'])),
-                                          ('Cache-Control', 'public, no-cache'),
-                                          ('Content-Length', str(md['bytes'])),
-                                          ('ETag', current_etag),
-                                          ('Last-Modified', last_modified_date)])
-
-                res = client.get_file(path, rev=md['rev'])
-                def gen():
-                    try:
-                        while True:
-                            ret = res.read(block_size)
-                            if not ret:
-                                break
-                            yield ret
-                    finally:
-                        res.close()
-
-                return gen()
+                def gen(res):
+                    return _ResponseBody(res, block_size)
+
+                if is_head:
+                    # everything a HEAD needs is in the metadata
+                    start_response('200 OK', headers)
+                    return []
+
+                ranges = requested_ranges(environ, md['bytes'],
+                                          current_etag, last_modified_date)
+                if ranges is not None:
+                    def read_range(start, end):
+                        with timed(environ, 'upstream'):
+                            res = client.get_file(path, rev=md['rev'],
+                                                  start=start, length=end - start + 1)
+                        return gen(res)
+                    return range_response(start_response, ranges, md['bytes'],
+                                          headers, read_range)
+
+                with timed(environ, 'upstream'):
+                    res = client.get_file(path, rev=md['rev'])
+                start_response('200 OK', headers)
+                return gen(res)
 
             toret = file_response
 
+        encoding = None
+        if compress and is_compressible(headers[0][1],
+                                        None if md['is_dir'] else md['bytes']):
+            # ranges are only served from the identity encoding
+            encoding = (None if 'HTTP_RANGE' in environ else
+                        negotiate(environ.get('HTTP_ACCEPT_ENCODING')))
+            if encoding is None:
+                headers.append(('Vary', 'Accept-Encoding'))
+            else:
+                headers = encoded_headers(headers, encoding)
+                # listings are compressed by render_listing()
+                if not is_head and not md['is_dir']:
+                    toret = _compressed(toret, encoding)
+
         try:
             if_modified_since = environ['HTTP_IF_MODIFIED_SINCE']
         except KeyError:
@@ -480,13 +679,32 @@ def make_app(config, impl):
         return_code = http_cache_logic(current_etag, current_modified_date,
                                        if_match, if_none_match, if_modified_since)
 
+        # let the caching middleware tell us if it already has
+        # (or is already fetching) this version of the data
+        should_fetch = environ.get('dropboxwsgi.should_fetch')
+        if (return_code == HTTP_OK and not is_head and
+            should_fetch is not None and not should_fetch(current_etag)):
+            # it might have the data under another path,
+            # so it needs all of our headers
+            return not_modified_response(environ, start_response, headers)
+
         if return_code == HTTP_PRECONDITION_FAILED:
             return precondition_failed_response(environ, start_response)
         elif return_code == HTTP_NOT_MODIFIED:
-            return not_modified_response(environ, start_response)
+            validators = [(k, v) for (k, v) in headers
+                          if k in ('ETag', 'Last-Modified')]
+            return not_modified_response(environ, start_response, validators)
         else:
             return toret(environ, start_response)
 
+    # expose hit/miss counters to whoever wants them
+    app.metadata_cache = metadata_cache
+    app.listing_cache = listing_cache
+    app.negative_cache = negative_cache
+    app.namespace = namespace
+    app.client_pool = client_pool
+    app.get_metadata = get_metadata
+
     return app
 
 if __name__ == "__main__":
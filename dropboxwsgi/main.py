@@ -29,7 +29,10 @@ import getopt
 import itertools
 import logging
 import os
+import socket
 import sys
+import threading
+import time
 import traceback
 
 try:
@@ -37,7 +40,8 @@ try:
 except Exception:
     import simplejson as json
 
-from wsgiref.simple_server import make_server
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
 from wsgiref.validate import validator
 
 try:
@@ -48,27 +52,182 @@ except ImportError:
     from collections import MutableMapping as DictDerive
 
 try:
-    from gevent import pywsgi
+    from gevent import monkey, pywsgi
 except ImportError:
     pywsgi = None
+else:
+    try:
+        from gevent import signal_handler as gevent_signal_handler
+    except ImportError:
+        # before gevent 1.5
+        from gevent import signal as gevent_signal_handler
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # python 2 needs the pysendfile package
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
+from .backends import LocalBackend
 from .dropboxwsgi import make_app, FileSystemCredStorage
-from .caching import make_caching, FileSystemCache
+from .caching import make_caching, FileSystemCache, WriteBehind
+from .metrics import REGISTRY, app_collector, make_metrics
+from .prefork import Master, bind_socket, run_worker
+from .timing import make_timing
 
 logger = logging.getLogger(__name__)
 
-def _start_server(app, host, port):
+class SendfileServerHandler(ServerHandler):
+    # copy results of wsgi.file_wrapper straight from the file to the
+    # socket, without ever passing the data through python
+    sendfile_block_size = 1024 * 1024
+
+    def sendfile(self):
+        if sendfile is None:
+            return False
+
+        filelike = self.result.filelike
+        try:
+            in_fd = filelike.fileno()
+            offset = filelike.tell()
+            end = os.fstat(in_fd).st_size
+            out_fd = self.stdout.fileno()
+        except Exception:
+            # not a real file (or socket), do it the slow way
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        while offset < end:
+            sent = sendfile(out_fd, in_fd, offset,
+                            min(self.sendfile_block_size, end - offset))
+            if not sent:
+                break
+            offset += sent
+            self.bytes_sent += sent
+
+        return True
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    def handle(self):
+        # same as WSGIRequestHandler.handle() except for the handler class
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class ListeningWSGIServer(WSGIServer):
+    # serves from a socket that is already listening, possibly
+    # shared with other processes, and can be stopped gracefully
+
+    def __init__(self, sock, app, handler_class=SendfileRequestHandler):
+        self.listening_socket = sock
+        WSGIServer.__init__(self, sock.getsockname()[:2], handler_class)
+        self.set_app(app)
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listening_socket
+        (host, port) = self.server_address = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def server_activate(self):
+        pass
+
+    def wait_idle(self, timeout):
+        # shutdown() already waited for the request being served
+        pass
+
+    def stop(self, timeout):
+        self.shutdown()
+        self.server_close()
+        self.wait_idle(timeout)
+
+class ThreadingListeningWSGIServer(ThreadingMixIn, ListeningWSGIServer):
+    daemon_threads = True
+
+    def __init__(self, *n, **kw):
+        self._active = 0
+        self._idle = threading.Condition()
+        ListeningWSGIServer.__init__(self, *n, **kw)
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self._active += 1
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self._finished()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self._idle:
+            self._active -= 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        deadline = time.time() + timeout
+        with self._idle:
+            while self._active:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning("Gave up waiting for %d requests", self._active)
+                    return
+                self._idle.wait(remaining)
+
+def _make_server(app, sock, threaded=False, graceful_timeout=30):
+    if pywsgi:
+        server = pywsgi.WSGIServer(sock, app)
+        # serve_forever() stops the server again once it is stopped,
+        # make sure that doesn't cut the graceful timeout short
+        server.stop_timeout = graceful_timeout
+        return server
+    elif threaded:
+        return ThreadingListeningWSGIServer(sock, app)
+    else:
+        return ListeningWSGIServer(sock, app)
+
+def _serve(app, sock, threaded=False, graceful_timeout=30):
     if pywsgi:
         logger.info("Server is running; using gevent server")
-        pywsgi.WSGIServer((host, port), app).serve_forever()
+        signal_kw = dict(signal_handler=gevent_signal_handler)
     else:
-        logger.info("Server is running; using wsgiref server")
-        make_server(host, port, app).serve_forever()
+        logger.info("Server is running; using %swsgiref server%s",
+                    "threaded " if threaded else "",
+                    " with sendfile" if sendfile is not None else "")
+        signal_kw = {}
+    run_worker(_make_server(app, sock, threaded, graceful_timeout),
+               graceful_timeout, **signal_kw)
 
 def console_output(str_, *args):
     print str_ % args
 
-def usage(options, err='', argv=None):
+def usage(options, err='', argv=None, description="Run the dropboxwsgi HTTP server."):
     if argv is None:
         argv = sys.argv
 
@@ -76,8 +235,8 @@ def usage(options, err='', argv=None):
         console_output('error: ' + err)
 
     console_output("""Usage: %s %s [OPTION]
-Run the dropboxwsgi HTTP server.
-""", sys.executable, argv[0])
+%s
+""", sys.executable, argv[0], description)
 
     def get_front_str(short, long_):
         if (short is not None and
@@ -127,7 +286,9 @@ Run the dropboxwsgi HTTP server.
         for elt in itertools.islice(min_seqs, 1, len(min_seqs)):
             console_output("%s  %s", " " * header_len, elt)
 
-def config_from_options(options, argv):
+def config_from_options(options, argv, description=None):
+    usage_kw = {} if description is None else dict(description=description)
+
     short_options = ''.join(itertools.chain(('%s:' % s for (_, _, s, _, _, _, _) in options
                                              if s is not None),
                                             ['h', 'c:']))
@@ -139,7 +300,7 @@ def config_from_options(options, argv):
         opts, args = getopt.getopt(argv[1:], short_options, long_options)
     except getopt.GetoptError, err:
         # print help information and exit
-        usage(options, str(err))
+        usage(options, str(err), **usage_kw)
         raise SystemExit()
 
     config = dict((k, d) for (k, _, _, _, _, d, _) in options)
@@ -173,7 +334,7 @@ def config_from_options(options, argv):
         try:
             dispatch[o](a)
         except Exception, e:
-            usage(options, err=str(e), argv=argv)
+            usage(options, err=str(e), argv=argv, **usage_kw)
             raise SystemExit()
 
     config_object.read(read_from)
@@ -201,11 +362,14 @@ def config_from_options(options, argv):
             raise NotImplementedError("Sorry")
 
         def __iter__(self):
+            # a shared config file can hold options for other commands,
+            # skip those since we can't look them up
             return itertools.chain(self.defaults,
                                    (o
                                     for sec in self.config.sections()
                                     for o in self.config.options(sec)
-                                    if o not in self.defaults))
+                                    if o not in self.defaults and
+                                    o in self.key_to_section))
 
         def __len__(self):
             return sum(1 for _ in self)
@@ -215,87 +379,240 @@ def config_from_options(options, argv):
 
     return TopConfigObject(config, config_object, options)
 
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv
+def log_level_from_string(a):
+    log_level_name = a.upper()
+    if log_level_name not in ["DEBUG", "INFO", "WARNING",
+                              "ERROR", "CRITICAL", "EXCEPTION"]:
+        raise Exception("not a log level: %r" % a)
+    return getattr(logging, log_level_name)
 
-    def log_level_from_string(a):
-        log_level_name = a.upper()
-        if log_level_name not in ["DEBUG", "INFO", "WARNING",
-                                  "ERROR", "CRITICAL", "EXCEPTION"]:
-            raise Exception("not a log level: %r" % a)
-        return getattr(logging, log_level_name)
-
-    def identity(a): return a
-
-    def access_type_from_string(a):
-        if a not in ['app_folder', 'dropbox']:
-            raise Exception("not an access type: %r" % a)
-            return 2
-        return a
-
-    def bool_from_string(a):
-        al = a.lower()
-        if al == 'true':
-            return True
-        elif al == 'false':
-            return False
-        else:
-            raise Exception("not a boolean: %r" % a)
-
-    def address_from_string(a):
-        splitted = a.split(':', 1)
-        if len(splitted) == 2:
-            host = splitted[0]
-            port = int(splitted[1])
-        else:
-            try:
-                port = int(a)
-                host = ''
-            except ValueError:
-                port = 80
-                host = a
-        return (host, port)
+def identity(a): return a
 
-    def list_from_csv(a):
-        return a.split(',')
+def access_type_from_string(a):
+    if a not in ['app_folder', 'dropbox']:
+        raise Exception("not an access type: %r" % a)
+        return 2
+    return a
+
+def bool_from_string(a):
+    al = a.lower()
+    if al == 'true':
+        return True
+    elif al == 'false':
+        return False
+    else:
+        raise Exception("not a boolean: %r" % a)
 
+def address_from_string(a):
+    splitted = a.split(':', 1)
+    if len(splitted) == 2:
+        host = splitted[0]
+        port = int(splitted[1])
+    else:
+        try:
+            port = int(a)
+            host = ''
+        except ValueError:
+            port = 80
+            host = a
+    return (host, port)
+
+def list_from_csv(a):
+    return a.split(',')
+
+def size_from_string(a):
+    units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+    a = a.strip().upper().rstrip('B')
+    if a and a[-1] in units:
+        return int(float(a[:-1]) * units[a[-1]])
+    return int(a)
+
+def server_options():
     # [(top_level_dict_key, config_section_name, short_option, long_option, from_string, default)]
-    options = [('log_level', 'Debugging', 'l', 'log-level', log_level_from_string,
-                logging.WARNING, ('set minimum level when outputting log data. LEVEL can be one of '
-                                  'debug, info, warning, error, critical, exception')),
-
-               ('consumer_key', 'Credentials', None, 'consumer-key', identity, None,
-                'consumer key to use when accessing the Dropbox API'),
-               ('consumer_secret', 'Credentials', None, 'consumer-secret', identity, None,
-                'consumer secret to use when accessing the Dropbox API'),
-               ('access_type', 'Credentials', None, 'access-type', access_type_from_string, None,
-                ('access type to use when accessing the Dropbox API. can be one of '
-                 'dropbox or app_folder')),
-
-               ('http_root', 'Server', None, 'http-root', identity, None,
-                ('http root to use when redirecting and creating absolute links, '
-                 'e.g. "http://www.example.com"')),
-               ('listen', 'Server', None, 'listen', address_from_string, ('', 80),
-                'address for server to listen on, e.g. "0.0.0.0:80"'),
-               ('enable_local_caching', 'Server', None, 'enable-local-caching', bool_from_string,
-                True, 'true if you want to cache data from the Dropbox API on this server, false otherwise'),
-               ('validate_wsgi', 'Server', None, 'validate-wsgi', bool_from_string, False,
-                ('true if you want to apply the wsgi.validator.validate '
-                 'decorator to this WSGI app, false otherwise')),
-               ('allow_directory_listing', 'Server', None, 'allow-directory-listing',
-                bool_from_string, True,
-                'true if you want to allow directory listings, false otherwise'),
-               ('index_file_names', 'Server', None, 'index-file-names',
-                list_from_csv, [],
-                'comma-separated list of file names to search for if a directory is requested'),
-
-               ('cache_dir', 'Storage', None, 'cache-dir', identity,
-                os.path.expanduser("~/.dropboxwsgi/cache"),
-                'path to use when caching data from the Dropbox API locally'),
-               ('app_dir', 'Storage', None, 'app-dir', identity,
-                os.path.expanduser("~/.dropboxwsgi"),
-                'path to use for storing internal app data, like access credentials')]
+    return [('log_level', 'Debugging', 'l', 'log-level', log_level_from_string,
+             logging.WARNING, ('set minimum level when outputting log data. LEVEL can be one of '
+                               'debug, info, warning, error, critical, exception')),
+            ('server_timing', 'Debugging', None, 'server-timing', bool_from_string, False,
+             ('true if you want to send a Server-Timing header with how long each '
+              'part of a request took, false otherwise')),
+            ('profile_dir', 'Debugging', None, 'profile-dir', identity, None,
+             'directory to write cProfile stats of sampled requests into'),
+            ('profile_rate', 'Debugging', None, 'profile-rate', float, 0.01,
+             ('fraction of requests to profile when profile-dir is set, '
+              'e.g. 0.01 for one in a hundred')),
+
+            ('consumer_key', 'Credentials', None, 'consumer-key', identity, None,
+             'consumer key to use when accessing the Dropbox API'),
+            ('consumer_secret', 'Credentials', None, 'consumer-secret', identity, None,
+             'consumer secret to use when accessing the Dropbox API'),
+            ('access_type', 'Credentials', None, 'access-type', access_type_from_string, None,
+             ('access type to use when accessing the Dropbox API. can be one of '
+              'dropbox or app_folder')),
+
+            ('http_root', 'Server', None, 'http-root', identity, None,
+             ('http root to use when redirecting and creating absolute links, '
+              'e.g. "http://www.example.com"')),
+            ('listen', 'Server', None, 'listen', address_from_string, ('', 80),
+             'address for server to listen on, e.g. "0.0.0.0:80"'),
+            ('workers', 'Server', None, 'workers', int, 1,
+             ('number of server processes, e.g. one per CPU core. each has its own '
+              'in-memory caches and metrics. send SIGHUP to restart them gracefully')),
+            ('threaded', 'Server', None, 'threaded', bool_from_string, False,
+             ('true if you want the wsgiref server to handle requests in threads, '
+              'false otherwise. the gevent server always handles them concurrently')),
+            ('graceful_timeout', 'Server', None, 'graceful-timeout', float, 30,
+             ('number of seconds a stopping or restarting server waits for requests '
+              'in progress to finish')),
+            ('enable_local_caching', 'Server', None, 'enable-local-caching', bool_from_string,
+             True, 'true if you want to cache data from the Dropbox API on this server, false otherwise'),
+            ('validate_wsgi', 'Server', None, 'validate-wsgi', bool_from_string, False,
+             ('true if you want to apply the wsgi.validator.validate '
+              'decorator to this WSGI app, false otherwise')),
+            ('allow_directory_listing', 'Server', None, 'allow-directory-listing',
+             bool_from_string, True,
+             'true if you want to allow directory listings, false otherwise'),
+            ('index_file_names', 'Server', None, 'index-file-names',
+             list_from_csv, [],
+             'comma-separated list of file names to search for if a directory is requested'),
+            ('metadata_cache_size', 'Server', None, 'metadata-cache-size', int, 10000,
+             'maximum number of Dropbox API metadata responses to keep in memory'),
+            ('metadata_cache_ttl', 'Server', None, 'metadata-cache-ttl', float, 0,
+             ('number of seconds to reuse Dropbox API metadata responses kept in memory, '
+              '0 disables the metadata cache')),
+            ('client_pool_size', 'Server', None, 'client-pool-size', int, 8,
+             'maximum number of simultaneous connections to the Dropbox API'),
+            ('client_pool_timeout', 'Server', None, 'client-pool-timeout', float, 30,
+             ('number of seconds a request waits for a free Dropbox API connection '
+              'before giving up')),
+            ('negative_cache_size', 'Server', None, 'negative-cache-size', int, 10000,
+             'maximum number of missing paths to remember'),
+            ('negative_cache_ttl', 'Server', None, 'negative-cache-ttl', float, 30,
+             ('number of seconds to answer requests for a missing path without asking '
+              'the Dropbox API again, 0 disables the negative cache')),
+            ('listing_cache_size', 'Server', None, 'listing-cache-size', int, 128,
+             ('maximum number of rendered directory listings to keep in memory, '
+              '0 disables the listing cache')),
+            ('enable_namespace_sync', 'Server', None, 'enable-namespace-sync', bool_from_string,
+             False, ('true if you want to keep a copy of all Dropbox metadata in memory, '
+                     'synced in the background, and answer metadata lookups from it')),
+            ('enable_compression', 'Server', None, 'enable-compression', bool_from_string,
+             False, ('true if you want to gzip (or brotli, if installed) compress text '
+                    'responses for clients that accept it, false otherwise')),
+            ('namespace_sync_interval', 'Server', None, 'namespace-sync-interval', float, 30,
+             'number of seconds to wait between checking Dropbox for metadata changes'),
+            ('namespace_save_interval', 'Server', None, 'namespace-save-interval', float, 300,
+             ('minimum number of seconds between saving the synced metadata to disk, '
+              'so restarts can pick up where they left off')),
+            ('metrics_path', 'Server', None, 'metrics-path', identity, None,
+             ('path to serve Prometheus metrics at, e.g. "/_metrics". it takes '
+              'precedence over any file at the same path in Dropbox')),
+
+            ('local_backend_dir', 'Backend', None, 'local-backend-dir', identity, None,
+             ('serve this local directory instead of a Dropbox, for load testing and '
+              'benchmarking without the Dropbox API')),
+            ('local_backend_latency', 'Backend', None, 'local-backend-latency', float, 0,
+             'number of seconds every call to the local backend takes'),
+            ('local_backend_jitter', 'Backend', None, 'local-backend-jitter', float, 0,
+             'maximum number of seconds randomly added to the local backend latency'),
+            ('local_backend_bandwidth', 'Backend', None, 'local-backend-bandwidth',
+             size_from_string, 0,
+             ('bytes per second the local backend sends file data at, e.g. "10M". '
+              '0 means no limit')),
+            ('local_backend_error_rate', 'Backend', None, 'local-backend-error-rate',
+             float, 0, 'fraction of local backend calls that fail, e.g. 0.01'),
+            ('local_backend_error_status', 'Backend', None, 'local-backend-error-status',
+             int, 503, 'HTTP status of the local backend failures'),
+
+            ('cache_dir', 'Storage', None, 'cache-dir', identity,
+             os.path.expanduser("~/.dropboxwsgi/cache"),
+             'path to use when caching data from the Dropbox API locally'),
+            ('cache_max_bytes', 'Storage', None, 'cache-max-bytes', size_from_string, 0,
+             ('maximum size of the local cache, e.g. "512M" or "20G", '
+              'least recently used data is removed first. 0 means no limit')),
+            ('cache_max_entries', 'Storage', None, 'cache-max-entries', int, 0,
+             'maximum number of files in the local cache, 0 means no limit'),
+            ('cache_max_age', 'Storage', None, 'cache-max-age', float, 0,
+             ('number of seconds to serve cached data without checking with '
+              'Dropbox that it is still current')),
+            ('cache_stale_while_revalidate', 'Storage', None, 'cache-stale-while-revalidate',
+             float, 0, ('number of seconds past cache-max-age to keep serving cached data '
+                        'immediately while checking it in the background')),
+            ('cache_stale_if_error', 'Storage', None, 'cache-stale-if-error', float, 0,
+             ('number of seconds past cache-max-age to keep serving cached data '
+              "if Dropbox can't be reached")),
+            ('cache_write_buffer', 'Storage', None, 'cache-write-buffer', size_from_string,
+             16 * 1024 * 1024,
+             ('amount of new data that can wait to be written to the local cache, e.g. "64M". '
+              "responses that don't fit aren't cached. 0 writes data before sending it on")),
+            ('cache_finish_fills', 'Storage', None, 'cache-finish-fills', size_from_string, 0,
+             ('keep saving a response to the local cache after its client goes away '
+              'if at most this much of it is left to download, e.g. "32M"')),
+            ('app_dir', 'Storage', None, 'app-dir', identity,
+             os.path.expanduser("~/.dropboxwsgi"),
+             'path to use for storing internal app data, like access credentials')]
+
+def backend_from_config(config):
+    if not config['local_backend_dir']:
+        return None
+    return LocalBackend(config['local_backend_dir'],
+                        latency=config['local_backend_latency'],
+                        jitter=config['local_backend_jitter'],
+                        bandwidth=config['local_backend_bandwidth'],
+                        error_rate=config['local_backend_error_rate'],
+                        error_status=config['local_backend_error_status'])
+
+def cache_from_config(config):
+    return FileSystemCache(config['cache_dir'],
+                           max_bytes=config['cache_max_bytes'],
+                           max_entries=config['cache_max_entries'])
+
+def with_defaults(config):
+    # library users may only set a few options
+    return dict(((opt[0], opt[5]) for opt in server_options()), **config)
+
+def write_behind_from_config(config):
+    if not config['cache_write_buffer']:
+        return None
+    return WriteBehind(config['cache_write_buffer'])
+
+def app_from_config(config, impl, cache=None, write_behind=None, backend=None):
+    """
+    The WSGI app the server runs: make_app() with the middlewares
+    `config` asks for on top of it. Options missing from `config`
+    have their defaults.
+    """
+    config = with_defaults(config)
+
+    app = make_app(config, impl, backend=backend)
+    REGISTRY.add_collector(app_collector(app))
+
+    if cache is not None:
+        app = make_caching(cache,
+                           compress=config['enable_compression'],
+                           max_age=config['cache_max_age'],
+                           stale_while_revalidate=config['cache_stale_while_revalidate'],
+                           stale_if_error=config['cache_stale_if_error'],
+                           write_behind=write_behind,
+                           finish_fill_bytes=config['cache_finish_fills'])(app)
+
+    if config['server_timing'] or config['profile_dir']:
+        app = make_timing(server_timing=config['server_timing'],
+                          profile_dir=config['profile_dir'],
+                          profile_rate=config['profile_rate'])(app)
+
+    if config['metrics_path']:
+        app = make_metrics(config['metrics_path'])(app)
+
+    if config['validate_wsgi']:
+        app = validator(app)
+
+    return app
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    options = server_options()
 
     try:
         config = config_from_options(options, argv)
@@ -309,16 +626,42 @@ def main(argv=None):
         usage(options, err="Must specify http-root!", argv=argv)
         return 3
 
-    app = make_app(config, FileSystemCredStorage(config['app_dir']))
-
-    if config['enable_local_caching']:
-        app = make_caching(FileSystemCache(config['cache_dir']))(app)
-
-    if config['validate_wsgi']:
-        app = validator(app)
+    if pywsgi and not monkey.is_module_patched('threading'):
+        # API requests and the locks used to coalesce concurrent
+        # requests have to yield to other greenlets, bin/dropboxwsgi
+        # does this before anything is imported
+        logger.warning("Patching the standard library for gevent late, "
+                       "locks created while importing won't yield")
+        monkey.patch_all()
+
+    # opening (and possibly rebuilding) the cache once, up front,
+    # saves the workers from racing to do it
+    cache = cache_from_config(config) if config['enable_local_caching'] else None
+
+    def serve(sock):
+        # the app starts threads and opens connections, so each
+        # worker makes its own after it is forked
+        write_behind = None if cache is None else write_behind_from_config(config)
+        try:
+            app = app_from_config(config, FileSystemCredStorage(config['app_dir']),
+                                  cache=cache, write_behind=write_behind,
+                                  backend=backend_from_config(config))
+            _serve(app, sock, config['threaded'], config['graceful_timeout'])
+        finally:
+            if write_behind is not None and not write_behind.drain(config['graceful_timeout']):
+                logger.warning("Gave up waiting for cache writes to finish")
+            if cache is not None:
+                cache.close()
 
     (host, port) = config['listen']
-    _start_server(app, host, port)
+    if config['workers'] > 1:
+        if cache is not None:
+            # each worker opens its own connection to the cache index
+            cache.close()
+        Master(serve, host, port, config['workers'],
+               config['graceful_timeout']).run()
+    else:
+        serve(bind_socket(host, port))
 
     return 0
 
@@ -0,0 +1,351 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Minimal Prometheus-style metrics. Updating a metric takes a lock and
+a dict lookup, cheap enough to leave on all the time; anything that's
+already counted elsewhere (pool and cache statistics) is collected only
+when the metrics are scraped.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import threading
+import time
+
+from .util import observe_body
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and v == int(v) and abs(v) < 1e15:
+        return '%d' % v
+    return repr(v)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+                             for (k, v) in pairs)
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _header(self):
+        return ['# HELP %s %s' % (self.name, self.doc),
+                '# TYPE %s %s' % (self.name, self.TYPE)]
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def labels(self, *labels):
+        return _Bound(self, labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for (labels, v) in items:
+            lines.append('%s%s %s' % (self.name, _format_labels(self.label_names, labels),
+                                      _format_value(v)))
+        return lines
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class _Bound(object):
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.label_values = labels
+
+    def inc(self, amount=1):
+        self.metric.inc(amount, *self.label_values)
+
+    def dec(self, amount=1):
+        self.metric.inc(-amount, *self.label_values)
+
+    def observe(self, value):
+        self.metric.observe(value, *self.label_values)
+
+# seconds, suits both local disk and API round trips
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts = self._values[labels]
+            except KeyError:
+                # one per bucket, then +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def labels(self, *labels):
+        return _Bound(self, labels)
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted((k, list(v)) for (k, v) in self._values.items())
+        for (labels, counts) in items:
+            total = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.label_names, labels, [('le', _format_value(bound))]),
+                    total))
+            label_str = _format_labels(self.label_names, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_str, _format_value(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, label_str, total))
+        return lines
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *n):
+        self.histogram.observe(time.time() - self.start, *self.labels)
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric):
+        with self._lock:
+            # modules may be reloaded, keep the first one
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, doc, labels=()):
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self._add(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def add_collector(self, collector):
+        """
+        `collector()` is called on every scrape and returns
+        [(name, type, doc, [(labels_dict, value)])].
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+            collectors = list(self._collectors)
+
+        lines = []
+        for (_, metric) in metrics:
+            lines.extend(metric.render())
+
+        for collector in collectors:
+            for (name, type_, doc, samples) in collector():
+                lines.append('# HELP %s %s' % (name, doc))
+                lines.append('# TYPE %s %s' % (name, type_))
+                for (labels, value) in samples:
+                    label_items = sorted(labels.items())
+                    lines.append('%s%s %s' % (name,
+                                              _format_labels([k for (k, _) in label_items],
+                                                             [v for (_, v) in label_items]),
+                                              _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+# shared by everything in the process, like the logging module's loggers
+REGISTRY = Registry()
+
+requests_total = REGISTRY.counter(
+    'dropboxwsgi_requests_total', 'HTTP requests by method and status',
+    ('method', 'status'))
+request_duration = REGISTRY.histogram(
+    'dropboxwsgi_request_duration_seconds',
+    'Time from receiving a request until its response body was closed')
+requests_in_flight = REGISTRY.gauge(
+    'dropboxwsgi_requests_in_flight', 'Requests currently being handled')
+bytes_served = REGISTRY.counter(
+    'dropboxwsgi_bytes_served_total', 'Response body bytes, by where they came from',
+    ('source',))
+
+upstream_duration = REGISTRY.histogram(
+    'dropboxwsgi_upstream_request_duration_seconds',
+    'Dropbox API call latency, until the response started for get_file',
+    ('method',))
+upstream_errors = REGISTRY.counter(
+    'dropboxwsgi_upstream_errors_total',
+    'Failed Dropbox API calls, by HTTP status (or "exception" if there was none)',
+    ('method', 'status'))
+upstream_streams = REGISTRY.gauge(
+    'dropboxwsgi_upstream_streams', 'get_file responses currently being read')
+
+cache_requests = REGISTRY.counter(
+    'dropboxwsgi_cache_requests_total', 'Requests through the caching middleware by outcome',
+    ('result',))
+
+cache_write_queue_bytes = REGISTRY.gauge(
+    'dropboxwsgi_cache_write_queue_bytes', 'Response data waiting to be written to the cache')
+cache_fills_dropped = REGISTRY.counter(
+    'dropboxwsgi_cache_fills_dropped_total',
+    'Responses that were not saved to the cache after all, by reason',
+    ('reason',))
+
+# where the body of each caching middleware outcome comes from,
+# compressed copies of cached data count as 'cache_variant'
+CACHE_SOURCES = dict(fresh='cache', stale='cache', hit='cache', link='cache',
+                     follow='cache', stale_error='cache', not_modified='cache',
+                     miss='upstream', bypass='upstream')
+
+def _bytes_source(environ):
+    source = CACHE_SOURCES.get(environ.get('dropboxwsgi.cache'), 'upstream')
+    if source == 'cache' and environ.get('dropboxwsgi.cache_variant'):
+        source = 'cache_variant'
+    return source
+
+def app_collector(app):
+    """
+    Collects the statistics make_app() already keeps.
+    """
+    def collect():
+        toret = []
+        pool = getattr(app, 'client_pool', None)
+        if pool is not None:
+            stats = pool.stats()
+            for k in ('size', 'in_use', 'idle', 'max_size'):
+                toret.append(('dropboxwsgi_client_pool_%s' % k, 'gauge',
+                              'Dropbox API client pool %s' % k.replace('_', ' '),
+                              [({}, stats[k])]))
+            for k in ('checkouts', 'waits', 'timeouts'):
+                toret.append(('dropboxwsgi_client_pool_%s_total' % k, 'counter',
+                              'Dropbox API client pool %s' % k, [({}, stats[k])]))
+            toret.append(('dropboxwsgi_client_pool_wait_seconds_total', 'counter',
+                          'Time spent waiting for a Dropbox API client',
+                          [({}, stats['wait_time'])]))
+
+        caches = []
+        for name in ('metadata_cache', 'listing_cache', 'negative_cache'):
+            cache = getattr(app, name, None)
+            if cache is not None:
+                caches.append((name, cache))
+        if caches:
+            toret.append(('dropboxwsgi_memory_cache_lookups_total', 'counter',
+                          'In-memory cache lookups by cache and result',
+                          [(dict(cache=name, result=result), getattr(cache, attr))
+                           for (name, cache) in caches
+                           for (result, attr) in (('hit', 'hits'), ('miss', 'misses'))]))
+            toret.append(('dropboxwsgi_memory_cache_entries', 'gauge',
+                          'In-memory cache sizes',
+                          [(dict(cache=name), len(cache)) for (name, cache) in caches]))
+        return toret
+    return collect
+
+def make_metrics(path, registry=REGISTRY):
+    """
+    Counts and times every request, and serves the metrics at `path`.
+    """
+    def wrapper(app):
+        def metrics_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+            return [registry.render().encode('utf8')]
+
+        def new_app(environ, start_response):
+            if environ['PATH_INFO'] == path:
+                return metrics_app(environ, start_response)
+
+            start = time.time()
+            method = environ['REQUEST_METHOD'].upper()
+            state = {}
+
+            def my_start_response(code, headers, exc_info=None):
+                state['status'] = code.split(' ', 1)[0]
+                for (k, v) in headers:
+                    if k.lower() == 'content-length':
+                        state['length'] = int(v)
+                if exc_info is None:
+                    return start_response(code, headers)
+                return start_response(code, headers, exc_info)
+
+            def finish(sent):
+                # `sent` is None if we couldn't count what was sent,
+                # then all we know is what was meant to be sent
+                requests_in_flight.dec()
+                requests_total.inc(1, method, state.get('status', '500'))
+                request_duration.observe(time.time() - start)
+                size = state.get('length', 0) if sent is None else sent
+                if size and method != 'HEAD':
+                    bytes_served.inc(size, _bytes_source(environ))
+
+            requests_in_flight.inc()
+            try:
+                res = app(environ, my_start_response)
+            except:
+                state.setdefault('status', '500')
+                finish(0)
+                raise
+
+            return observe_body(environ, res, finish)
+        return new_app
+    return wrapper
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Converts a cache directory written by an older version of dropboxwsgi
+to the current layout: per-path tag.txt files are moved into the cache
+index and blobs into their fan-out directories.
+
+Opening the cache does this anyway, this tool is for doing it (and
+any evictions due to changed limits) ahead of a deploy rather than
+while the server is starting.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import sys
+import time
+
+from .main import cache_from_config, config_from_options, console_output, server_options
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    description = "Convert a dropboxwsgi cache to the current on-disk layout."
+    options = server_options()
+
+    try:
+        config = config_from_options(options, argv, description=description)
+    except SystemExit, e:
+        return 2
+
+    # the interesting bits are logged at info level
+    logging.basicConfig(level=min(config['log_level'], logging.INFO))
+
+    start = time.time()
+    cache = cache_from_config(config)
+    try:
+        (entries, bytes_) = cache.index.totals()
+    finally:
+        cache.close()
+
+    console_output("Cache in %r holds %d entries (%.1f MiB), converted in %.1fs",
+                   config['cache_dir'], entries, bytes_ / float(1024 * 1024),
+                   time.time() - start)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
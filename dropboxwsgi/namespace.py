@@ -0,0 +1,253 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def _parent(lc_path):
+    parent = lc_path.rsplit(u'/', 1)[0]
+    return parent or u'/'
+
+def _normalize(path):
+    lc_path = path.lower().rstrip(u'/')
+    return lc_path or u'/'
+
+class NamespaceIndex(object):
+    """
+    In-memory copy of the metadata tree of a Dropbox namespace, kept up
+    to date by applying the output of the /delta API call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cursor = None
+        self.ready = False
+        self._reset()
+
+    def _reset(self):
+        # lower-cased path -> metadata (without 'contents')
+        self._entries = {u'/': dict(path=u'/', is_dir=True,
+                                    bytes=0, size=u'0 bytes')}
+        # lower-cased folder path -> set of lower-cased child paths
+        self._children = {u'/': set()}
+        # lower-cased folder path -> computed folder hash
+        self._hashes = {}
+
+    def _remove(self, lc_path):
+        md = self._entries.pop(lc_path, None)
+        if md is None:
+            return
+
+        parent = _parent(lc_path)
+        self._children[parent].discard(lc_path)
+        self._hashes.pop(parent, None)
+
+        if md['is_dir']:
+            for child in list(self._children.get(lc_path, ())):
+                self._remove(child)
+            del self._children[lc_path]
+            self._hashes.pop(lc_path, None)
+
+    def _add(self, lc_path, md):
+        old = self._entries.get(lc_path)
+        if old is not None and old['is_dir'] != md['is_dir']:
+            self._remove(lc_path)
+            old = None
+
+        parent = _parent(lc_path)
+        if parent not in self._entries:
+            # the API expects us to create missing parent folders
+            # on our own
+            parent_path = md['path'].rsplit(u'/', 1)[0] or u'/'
+            self._add(parent, dict(path=parent_path, is_dir=True,
+                                   bytes=0, size=u'0 bytes',
+                                   modified=md.get('modified')))
+        elif not self._entries[parent]['is_dir']:
+            self._remove(parent)
+            return self._add(lc_path, md)
+
+        md = dict(md)
+        md.pop('contents', None)
+        self._entries[lc_path] = md
+        self._children[parent].add(lc_path)
+        self._hashes.pop(parent, None)
+        if md['is_dir'] and old is None:
+            self._children[lc_path] = set()
+
+    def apply_delta(self, reset, entries, cursor):
+        with self._lock:
+            if reset:
+                self._reset()
+
+            for (lc_path, md) in entries:
+                lc_path = _normalize(lc_path)
+                if lc_path == u'/':
+                    continue
+
+                if md is None:
+                    self._remove(lc_path)
+                else:
+                    self._add(lc_path, md)
+
+            self.cursor = cursor
+
+    def _hash(self, lc_path):
+        try:
+            return self._hashes[lc_path]
+        except KeyError:
+            pass
+
+        h = hashlib.md5()
+        for child in sorted(self._children[lc_path]):
+            md = self._entries[child]
+            h.update(repr((child, md.get('rev'), md.get('modified'))).encode('utf8'))
+        toret = self._hashes[lc_path] = h.hexdigest()
+        return toret
+
+    def metadata(self, path, list_=False):
+        """
+        Returns metadata in the same shape as DropboxClient.metadata(),
+        missing paths are returned as deleted entries.
+        """
+        lc_path = _normalize(path)
+        with self._lock:
+            try:
+                md = self._entries[lc_path]
+            except KeyError:
+                return dict(path=path, is_dir=False, is_deleted=True)
+
+            if not md['is_dir']:
+                return md
+
+            md = dict(md, hash=self._hash(lc_path))
+            if list_:
+                md['contents'] = [self._entries[child]
+                                  for child in self._children[lc_path]]
+            return md
+
+    def to_state(self):
+        with self._lock:
+            return dict(cursor=self.cursor,
+                        entries=[(k, v) for (k, v) in self._entries.iteritems()
+                                 if k != u'/'])
+
+    def load_state(self, state):
+        # the saved state can be arbitrarily old, so the index only
+        # becomes ready once it has caught up with a sync
+        self.apply_delta(True, state['entries'], state['cursor'])
+
+class NamespaceSyncer(object):
+    """
+    Keeps a NamespaceIndex in sync with Dropbox from a background thread.
+    `storage` must implement read_namespace_state()/write_namespace_state()
+    so restarts can resume from the last saved cursor. The state is
+    saved at most every `save_interval` seconds, and after a reset.
+    """
+
+    def __init__(self, client, index, storage, is_linked, interval=30,
+                 save_interval=300, clock=time.time):
+        self.client = client
+        self.index = index
+        self.storage = storage
+        self.is_linked = is_linked
+        self.interval = interval
+        self.save_interval = save_interval
+        self.clock = clock
+        self.dirty = False
+        self.last_save = clock()
+
+    def load(self):
+        try:
+            state = self.storage.read_namespace_state()
+        except Exception:
+            logger.debug("No saved namespace state, starting from scratch")
+            return
+
+        try:
+            self.index.load_state(state)
+        except Exception:
+            logger.exception("Bad saved namespace state, starting from scratch")
+            self.index.apply_delta(True, [], None)
+        else:
+            logger.info("Resuming namespace sync from saved cursor")
+
+    def sync_once(self):
+        # collect all pages first so a reset never leaves the index
+        # half-empty while requests are being served from it
+        reset = False
+        entries = []
+        cursor = self.index.cursor
+        while True:
+            delta = self.client.delta(cursor)
+            if delta['reset']:
+                reset = True
+                entries = []
+            entries.extend(delta['entries'])
+            cursor = delta['cursor']
+            if not delta['has_more']:
+                break
+
+        changed = reset or entries or cursor != self.index.cursor
+        self.index.apply_delta(reset, entries, cursor)
+        self.index.ready = True
+
+        if changed:
+            logger.debug("Applied %d namespace changes", len(entries))
+            self.dirty = True
+
+        # a reset means a full listing, which is worth not redoing
+        if reset or self.clock() - self.last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.storage.write_namespace_state(self.index.to_state())
+        except Exception:
+            logger.exception("Couldn't save namespace state")
+        else:
+            self.dirty = False
+            self.last_save = self.clock()
+
+    def run(self):
+        self.load()
+        while True:
+            if self.is_linked():
+                try:
+                    self.sync_once()
+                except Exception:
+                    logger.exception("Error while syncing namespace")
+            time.sleep(self.interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='namespace-sync')
+        t.daemon = True
+        t.start()
+        return t
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+from .metrics import upstream_duration, upstream_errors, upstream_streams
+from .six import reraise
+
+logger = logging.getLogger(__name__)
+
+def _error_status(e):
+    status = getattr(e, 'status', None)
+    return 'exception' if status is None else str(status)
+
+class PoolTimeout(Exception):
+    pass
+
+class ClientPool(object):
+    """
+    A bounded pool of Dropbox API clients. Each client keeps its own
+    keep-alive connection, so a request checks one out for as long as
+    it is talking to the API instead of everyone sharing (and
+    serializing on) a single connection. Every API call checks a client
+    out, so a `limiter` (a util.RateLimiter) limits the rate of calls.
+    """
+
+    def __init__(self, factory, max_size, timeout=None, clock=time.time,
+                 limiter=None):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive: %r" % max_size)
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.clock = clock
+        self.limiter = limiter
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+
+        # metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def checkout(self):
+        if self.limiter is not None:
+            self.limiter.wait()
+
+        start = self.clock()
+        create = False
+        with self._cond:
+            waited = False
+            while not self._idle and self._size >= self.max_size:
+                waited = True
+                remaining = None
+                if self.timeout is not None:
+                    remaining = start + self.timeout - self.clock()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("No Dropbox API client available after %ss" %
+                                          self.timeout)
+                self._cond.wait(remaining)
+
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                # create it outside of the lock
+                self._size += 1
+                create = True
+            self._in_use += 1
+            self.checkouts += 1
+            if waited:
+                waited_for = self.clock() - start
+                self.waits += 1
+                self.wait_time += waited_for
+                self.max_wait_time = max(self.max_wait_time, waited_for)
+
+        if create:
+            try:
+                client = self.factory()
+            except:
+                with self._cond:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+
+        return client
+
+    def checkin(self, client):
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append(client)
+            self._cond.notify()
+
+    def discard(self, client):
+        # for clients whose connection is in an unknown state
+        with self._cond:
+            self._in_use -= 1
+            self._size -= 1
+            self._cond.notify()
+
+    def release_after_error(self, client, e):
+        # API errors come with a complete response, so the
+        # connection can still be used
+        if getattr(e, 'status', None) is not None:
+            self.checkin(client)
+        else:
+            self.discard(client)
+
+    @contextlib.contextmanager
+    def client(self):
+        client = self.checkout()
+        try:
+            yield client
+        except Exception, e:
+            exc_info = sys.exc_info()
+            self.release_after_error(client, e)
+            reraise(*exc_info)
+        else:
+            self.checkin(client)
+
+    def stats(self):
+        with self._cond:
+            return dict(max_size=self.max_size,
+                        size=self._size,
+                        in_use=self._in_use,
+                        idle=len(self._idle),
+                        utilisation=self._in_use / float(self.max_size),
+                        checkouts=self.checkouts,
+                        waits=self.waits,
+                        timeouts=self.timeouts,
+                        wait_time=self.wait_time,
+                        max_wait_time=self.max_wait_time)
+
+class _PooledResponse(object):
+    # hands the client back once the body has been read and closed
+    def __init__(self, res, release):
+        self._res = res
+        self._release = release
+
+    def read(self, *n):
+        return self._res.read(*n)
+
+    def close(self):
+        release = self._release
+        if release is None:
+            return
+        self._release = None
+        try:
+            self._res.close()
+        finally:
+            release()
+
+    def __getattr__(self, name):
+        return getattr(self._res, name)
+
+class PooledClient(object):
+    """
+    Looks like a DropboxClient, but runs every call on a client checked
+    out of `pool`. Responses from get_file() keep their client until
+    they are closed.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_file(self, *n, **kw):
+        client = self.pool.checkout()
+        start = time.time()
+        try:
+            res = client.get_file(*n, **kw)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            upstream_errors.inc(1, 'get_file', _error_status(e))
+            self.pool.release_after_error(client, e)
+            reraise(*exc_info)
+        upstream_duration.observe(time.time() - start, 'get_file')
+        upstream_streams.inc()
+
+        done = []
+        def release():
+            if not done:
+                done.append(True)
+                upstream_streams.dec()
+                self.pool.checkin(client)
+        return _PooledResponse(res, release)
+
+    def __getattr__(self, name):
+        def call(*n, **kw):
+            with self.pool.client() as client:
+                start = time.time()
+                try:
+                    toret = getattr(client, name)(*n, **kw)
+                except Exception, e:
+                    # metadata(hash=...) says "not modified" by raising
+                    if getattr(e, 'status', None) == 304:
+                        upstream_duration.observe(time.time() - start, name)
+                    else:
+                        upstream_errors.inc(1, name, _error_status(e))
+                    raise
+                upstream_duration.observe(time.time() - start, name)
+                return toret
+        call.__name__ = name
+        return call
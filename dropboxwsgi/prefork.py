@@ -0,0 +1,241 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Pre-forking process manager. The master process keeps `workers`
+children serving the same port, each with its own app, and restarts
+any that die.
+
+Each worker binds its own SO_REUSEPORT socket where the platform has
+it, so the kernel spreads connections between them; elsewhere they
+all accept from one socket bound by the master.
+
+Signals to the master:
+
+SIGHUP          graceful restart: start a new set of workers, then
+                stop the old ones
+SIGTERM/SIGINT  graceful shutdown
+
+Stopping workers close their socket and get `graceful_timeout` seconds
+to finish the requests they are serving before they are killed. With
+SO_REUSEPORT, connections still waiting in a stopping worker's accept
+queue are reset, which only happens if they arrive in the moment
+between a new worker starting and the old one closing its socket.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+# minimum number of seconds between starting workers in the same slot,
+# so a worker that can't start doesn't fork bomb us
+RESPAWN_INTERVAL = 1
+
+def bind_socket(host, port, reuseport=False, backlog=128):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def reuseport_available(host, port):
+    if SO_REUSEPORT is None:
+        return False
+    try:
+        bind_socket(host, port, reuseport=True).close()
+    except socket.error, e:
+        if e.errno in (errno.ENOPROTOOPT, errno.EINVAL):
+            # defined, but not supported by this kernel
+            return False
+        raise
+    return True
+
+def run_worker(server, graceful_timeout, signal_handler=signal.signal):
+    """
+    Runs `server` until SIGTERM or SIGINT, then waits up to
+    `graceful_timeout` seconds for it to finish what it is serving.
+    `server` needs serve_forever() and stop(timeout), like
+    gevent's servers.
+    """
+    stopping = []
+    def stop(*n):
+        if stopping:
+            return
+        logger.debug("Worker %d stopping", os.getpid())
+        t = threading.Thread(target=server.stop, args=(graceful_timeout,))
+        t.daemon = True
+        stopping.append(t)
+        t.start()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal_handler(signum, stop)
+
+    server.serve_forever()
+    if stopping:
+        stopping[0].join(graceful_timeout)
+
+class Master(object):
+    def __init__(self, serve, host, port, workers, graceful_timeout=30):
+        """
+        `serve(sock)` is called in each worker process with its
+        listening socket, and should serve requests from it until told
+        to stop (see run_worker()).
+        """
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+
+        self.reuseport = reuseport_available(host, port)
+        self.sock = None if self.reuseport else bind_socket(host, port)
+
+        # pid -> slot of the current workers
+        self._current = {}
+        # pid -> time to kill it, for workers that are stopping
+        self._retiring = {}
+        # slot -> last start time
+        self._started = {}
+        self._signals = []
+
+    def _spawn(self, slot):
+        wait = self._started.get(slot, 0) + RESPAWN_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._started[slot] = time.time()
+
+        pid = os.fork()
+        if pid:
+            self._current[pid] = slot
+            return pid
+
+        # in the worker
+        status = 1
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            sock = self.sock
+            if sock is None:
+                sock = bind_socket(self.host, self.port, reuseport=True)
+            logger.debug("Worker %d started", os.getpid())
+            self.serve(sock)
+            status = 0
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _retire(self, pids):
+        deadline = time.time() + self.graceful_timeout + RESPAWN_INTERVAL
+        for pid in pids:
+            self._current.pop(pid, None)
+            self._retiring[pid] = deadline
+            self._kill(pid, signal.SIGTERM)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+
+            if self._retiring.pop(pid, None) is not None:
+                logger.debug("Worker %d exited", pid)
+                continue
+
+            slot = self._current.pop(pid, None)
+            if slot is not None:
+                logger.warning("Worker %d died (status %d), starting another", pid, status)
+                self._spawn(slot)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+
+        logger.info("Starting %d workers%s", self.workers,
+                    " with SO_REUSEPORT" if self.reuseport else "")
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while self._current or self._retiring:
+            self._reap()
+
+            now = time.time()
+            for (pid, deadline) in list(self._retiring.items()):
+                if now >= deadline:
+                    logger.warning("Worker %d didn't stop in time, killing it", pid)
+                    self._retiring[pid] = now + RESPAWN_INTERVAL
+                    self._kill(pid, signal.SIGKILL)
+
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    logger.info("Restarting workers")
+                    old = list(self._current)
+                    # new workers first, so someone is always accepting
+                    self._started.clear()
+                    for slot in range(self.workers):
+                        self._spawn(slot)
+                    self._retire(old)
+                elif self._current:
+                    logger.info("Stopping workers")
+                    self._retire(list(self._current))
+
+            time.sleep(0.2)
+
+        if self.sock is not None:
+            self.sock.close()
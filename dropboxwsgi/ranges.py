@@ -0,0 +1,199 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import uuid
+
+from .six import b
+
+# refuse to do more work than this per request, a client asking for
+# more ranges than this is most likely up to no good
+MAX_RANGES = 64
+
+def parse_range_header(value, size):
+    """
+    Parses the value of a Range header against an entity of `size`
+    bytes. Returns None if the header should be ignored, an empty
+    list if it isn't satisfiable, or a sorted list of inclusive
+    (start, end) tuples with overlapping ranges merged.
+    """
+    try:
+        unit, spec = value.split('=', 1)
+    except ValueError:
+        return None
+
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+
+        try:
+            first, last = part.split('-', 1)
+            first = first.strip()
+            last = last.strip()
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+            else:
+                # suffix range, the last N bytes
+                suffix = int(last)
+                if not suffix:
+                    continue
+                start = max(size - suffix, 0)
+                end = size - 1
+        except ValueError:
+            return None
+
+        if start < 0:
+            return None
+
+        if start >= size:
+            continue
+
+        ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    ranges.sort()
+    merged = []
+    for (start, end) in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+def requested_ranges(environ, size, etag, last_modified):
+    """
+    Returns the ranges to serve for this request, see
+    parse_range_header(). `etag` and `last_modified` (an HTTP date
+    string or None) are the current validators and are checked against
+    If-Range.
+    """
+    try:
+        range_header = environ['HTTP_RANGE']
+    except KeyError:
+        return None
+
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range is not None:
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # only strong comparison is allowed for If-Range
+            if if_range != etag:
+                return None
+        elif if_range != last_modified:
+            return None
+
+    return parse_range_header(range_header, size)
+
+def content_range(start, end, size):
+    return 'bytes %d-%d/%d' % (start, end, size)
+
+def unsatisfiable_content_range(size):
+    return 'bytes */%d' % size
+
+def make_boundary():
+    return uuid.uuid4().hex
+
+def _part_header(boundary, content_type, start, end, size):
+    return b('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' %
+             (boundary, content_type, content_range(start, end, size)))
+
+def _closing_delimiter(boundary):
+    return b('\r\n--%s--\r\n' % boundary)
+
+def multipart_length(ranges, size, content_type, boundary):
+    return (sum(len(_part_header(boundary, content_type, start, end, size)) +
+                end - start + 1
+                for (start, end) in ranges) +
+            len(_closing_delimiter(boundary)))
+
+def multipart_byteranges(ranges, size, content_type, boundary, read_range):
+    """
+    Generates a multipart/byteranges body. `read_range(start, end)`
+    must return an iterable over the bytes of that range.
+    """
+    for (start, end) in ranges:
+        yield _part_header(boundary, content_type, start, end, size)
+        for data in read_range(start, end):
+            yield data
+    yield _closing_delimiter(boundary)
+
+def read_file_range(f, base, start, end, block_size):
+    """
+    Reads the inclusive range [start, end] from `f`, where the entity
+    starts at offset `base` in the file.
+    """
+    f.seek(base + start)
+    left = end - start + 1
+    while left > 0:
+        data = f.read(min(block_size, left))
+        if not data:
+            break
+        left -= len(data)
+        yield data
+
+def range_response(start_response, ranges, size, headers, read_range):
+    """
+    Starts a 206 or 416 response for `ranges` (as returned by
+    requested_ranges()) given the `headers` of the full 200 response.
+    """
+    content_type = 'application/octet-stream'
+    new_headers = []
+    for (k, v) in headers:
+        kl = k.lower()
+        if kl == 'content-type':
+            content_type = v
+        elif kl != 'content-length':
+            new_headers.append((k, v))
+
+    if not ranges:
+        start_response('416 REQUESTED RANGE NOT SATISFIABLE',
+                       [('Content-Type', 'text/plain'),
+                        ('Content-Range', unsatisfiable_content_range(size))])
+        return [b('Requested Range Not Satisfiable!')]
+
+    if len(ranges) == 1:
+        (start, end) = ranges[0]
+        new_headers.extend([('Content-Type', content_type),
+                            ('Content-Range', content_range(start, end, size)),
+                            ('Content-Length', str(end - start + 1))])
+        start_response('206 PARTIAL CONTENT', new_headers)
+        return read_range(start, end)
+
+    boundary = make_boundary()
+    new_headers.extend([('Content-Type', 'multipart/byteranges; boundary=%s' % boundary),
+                        ('Content-Length', str(multipart_length(ranges, size, content_type,
+                                                                boundary)))])
+    start_response('206 PARTIAL CONTENT', new_headers)
+    return multipart_byteranges(ranges, size, content_type, boundary, read_range)
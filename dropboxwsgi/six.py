@@ -19,3 +19,14 @@ def r(str_, enc='latin1'):
     if sys.version_info < (3,):
         str_ = str_.encode(enc)
     return str_
+
+if sys.version_info >= (3,):
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
+else:
+    # the three argument raise is a syntax error in python 3, and
+    # 2to3 would wrap `value` in a new `tp`, losing its attributes
+    exec("def reraise(tp, value, tb=None):\n"
+         "    raise tp, value, tb\n")
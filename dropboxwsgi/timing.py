@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Per-request phase timings. The app and the caching middleware wrap
+the interesting parts of a request in `timed(environ, name)`, which
+does nothing unless `make_timing()` put a `Timings` in the environ.
+Phases that finish before the response starts are sent back in a
+Server-Timing header; the time spent sending the body is only logged.
+
+`make_timing()` can also run a sample of requests under cProfile and
+dump the stats into a directory, for `python -m pstats` or snakeviz.
+"""
+
+from __future__ import absolute_import
+
+import cProfile
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from .util import observe_body
+
+logger = logging.getLogger(__name__)
+
+TIMINGS_KEY = 'dropboxwsgi.timings'
+
+class Timings(object):
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+
+    def add(self, name, duration):
+        self.phases.append((name, duration))
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def header(self, total=None):
+        phases = list(self.phases)
+        if total is not None:
+            phases.append(('total', total))
+        return ', '.join('%s;dur=%.3f' % (name, duration * 1000)
+                         for (name, duration) in phases)
+
+class _Phase(object):
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.time() - self.start)
+        return False
+
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+def timed(environ, name):
+    timings = environ.get(TIMINGS_KEY)
+    if timings is None:
+        return _NO_PHASE
+    return timings.phase(name)
+
+def make_timing(server_timing=True, profile_dir=None, profile_rate=0.0):
+    """
+    Adds a Server-Timing header to every response if `server_timing`
+    is true, and writes cProfile stats for a random `profile_rate`
+    fraction of requests into `profile_dir`.
+    """
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+
+    if profile_dir is not None and not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+
+    def dump_profile(profiler, environ, timings):
+        with counter_lock:
+            n = counter.next()
+        fn = os.path.join(profile_dir, '%d-%d-%d.prof' %
+                          (int(timings.start * 1000), os.getpid(), n))
+        try:
+            profiler.dump_stats(fn)
+        except Exception:
+            logger.exception("Couldn't write profile")
+        else:
+            logger.info("Wrote profile of %s %r to %s", environ['REQUEST_METHOD'],
+                        environ['PATH_INFO'], fn)
+
+    def wrapper(app):
+        def new_app(environ, start_response):
+            timings = environ[TIMINGS_KEY] = Timings()
+
+            profiler = None
+            if profile_dir is not None and random.random() < profile_rate:
+                profiler = cProfile.Profile()
+
+            def my_start_response(code, headers, exc_info=None):
+                if server_timing:
+                    headers = headers + [('Server-Timing',
+                                          timings.header(time.time() - timings.start))]
+                if exc_info is None:
+                    return start_response(code, headers)
+                return start_response(code, headers, exc_info)
+
+            def finish(sent=None):
+                if app_done:
+                    timings.add('body', time.time() - app_done[0])
+                logger.debug("%s %r: %s", environ['REQUEST_METHOD'],
+                             environ['PATH_INFO'], timings.header())
+                if profiler is not None:
+                    dump_profile(profiler, environ, timings)
+
+            app_done = []
+            if profiler is not None:
+                profiler.enable()
+            try:
+                with timings.phase('app'):
+                    res = app(environ, my_start_response)
+            except:
+                if profiler is not None:
+                    profiler.disable()
+                finish()
+                raise
+            if profiler is not None:
+                profiler.disable()
+            app_done.append(time.time())
+
+            return observe_body(environ, res, finish, profiler)
+        return new_app
+    return wrapper
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import inspect
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from .six import reraise
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping that evicts the least recently used
+    entry once it holds more than `max_size` items. If `ttl` is given,
+    entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive: %r" % max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (expires, value) = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.clock():
+                self.misses += 1
+                return default
+
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key, only the first caller
+    runs the function and everyone else waits for and shares its result
+    (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *n, **kw):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info is not None:
+                reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = fn(*n, **kw)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+class RateLimiter(object):
+    """
+    Lets callers of wait() through at no more than `rate` per second
+    on average, allowing bursts of up to `burst`.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive: %r" % rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = clock()
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # take our token now, even if it's not there yet,
+            # so concurrent callers queue up behind us
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            self.sleep(delay)
+
+class ClosingIterator(object):
+    """
+    Iterates over the generator `gen`, but unlike a bare generator
+    runs `cleanup` if it is closed before iteration starts (when the
+    generator's own finally clauses never run). Once started, `gen`
+    is expected to clean up after itself.
+    """
+
+    def __init__(self, gen, cleanup):
+        self.gen = gen
+        self.cleanup = cleanup
+        self.started = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.started = True
+        return self.gen.next()
+
+    def close(self):
+        if not self.started:
+            self.started = True
+            try:
+                self.cleanup()
+            finally:
+                self.gen.close()
+        else:
+            self.gen.close()
+
+class ObservedBody(object):
+    """
+    Wraps the response body `res` to call finish(sent), with the number
+    of bytes handed to the server, once it is closed; even if that
+    happens before iteration starts. `profiler` (a cProfile.Profile)
+    is enabled while `res` produces each chunk.
+    """
+
+    def __init__(self, res, finish, profiler=None):
+        self.res = res
+        self.finish = finish
+        self.profiler = profiler
+        self.sent = 0
+
+    def __iter__(self):
+        it = iter(self.res)
+        profiler = self.profiler
+        while True:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                data = it.next()
+            except StopIteration:
+                return
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            self.sent += len(data)
+            yield data
+
+    def close(self):
+        finish = self.finish
+        if finish is None:
+            return
+        self.finish = None
+        try:
+            if hasattr(self.res, 'close'):
+                self.res.close()
+        finally:
+            finish(self.sent)
+
+def observe_body(environ, res, finish, profiler=None):
+    """
+    Returns `res` wrapped in an ObservedBody. Without a `profiler`,
+    bodies made with the server's wsgi.file_wrapper are returned as
+    they are, so the server can still send them with sendfile(), and
+    finish(None) is called once they're closed.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if (profiler is None and inspect.isclass(file_wrapper) and
+        isinstance(res, file_wrapper)):
+        orig_close = getattr(res, 'close', None)
+        def close():
+            try:
+                if orig_close is not None:
+                    orig_close()
+            finally:
+                finish(None)
+        try:
+            res.close = close
+        except AttributeError:
+            pass
+        else:
+            return res
+
+    return ObservedBody(res, finish, profiler)
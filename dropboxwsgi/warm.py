@@ -0,0 +1,289 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Fills the local cache ahead of traffic, either by walking a Dropbox
+folder or by replaying the paths in an access log. Requests go
+through the same WSGI stack the server uses, so the cache ends up
+exactly as if clients had asked for everything.
+"""
+
+from __future__ import absolute_import
+
+import Queue
+import logging
+import re
+import sys
+import threading
+import time
+import urllib
+
+from wsgiref.util import setup_testing_defaults
+
+from .caching import get_from_alist, make_caching, methodcaller
+from .dropboxwsgi import make_app, FileSystemCredStorage
+from .main import (backend_from_config, bool_from_string, cache_from_config,
+                   config_from_options, console_output, identity, server_options, usage)
+from .util import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# "GET /path HTTP/1.1" 200 in common/combined log format lines
+ACCESS_LOG_RE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[0-9.]+" (\d{3}) ')
+
+def paths_from_access_log(f):
+    """
+    Yields the distinct paths of successful requests in access log `f`.
+    """
+    seen = set()
+    for line in f:
+        m = ACCESS_LOG_RE.search(line)
+        if m is None or m.group(2) not in ('200', '206', '304'):
+            continue
+
+        path = urllib.unquote(m.group(1).split('?', 1)[0])
+        if isinstance(path, bytes):
+            try:
+                path = path.decode('utf8')
+            except UnicodeDecodeError:
+                continue
+
+        if path not in seen:
+            seen.add(path)
+            yield path
+
+def _path_info(path):
+    # what a WSGI server would put in PATH_INFO for `path`
+    path = path.encode('utf8')
+    if sys.version_info >= (3,):
+        path = path.decode('latin1')
+    return path
+
+class Warmer(object):
+    """
+    Requests paths through `app` on `threads` threads, skipping the
+    ones `cache` already has the current version of. `rate` limits
+    the number of Dropbox API calls per second made through `pool`,
+    the app's ClientPool.
+    """
+
+    def __init__(self, app, cache, get_metadata, threads=8, rate=None,
+                 listings=True, pool=None):
+        self.app = app
+        self.cache = cache
+        self.get_metadata = get_metadata
+        self.threads = threads
+        self.listings = listings
+
+        if rate:
+            if pool is None:
+                raise ValueError("Need the client pool to limit the rate of API calls")
+            # charges for every call, including the ones the app
+            # makes while answering our requests
+            pool.limiter = RateLimiter(rate, burst=threads)
+
+        self._lock = threading.Lock()
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def _count(self, **kw):
+        with self._lock:
+            for (k, v) in kw.iteritems():
+                setattr(self, k, getattr(self, k) + v)
+
+    def _is_current(self, path, etag):
+        try:
+            h = self.cache.read_cached_headers(_path_info(path))
+        except Exception:
+            return False
+        return get_from_alist(h, 'etag', key=methodcaller('lower')) == etag
+
+    def _fetch(self, path):
+        environ = {'REQUEST_METHOD': 'GET',
+                   'PATH_INFO': _path_info(path)}
+        setup_testing_defaults(environ)
+
+        status = []
+        def start_response(code, headers, exc_info=None):
+            status[:] = [code]
+            return lambda data: None
+
+        res = self.app(environ, start_response)
+        size = 0
+        try:
+            for data in res:
+                size += len(data)
+        finally:
+            if hasattr(res, 'close'):
+                res.close()
+
+        if not status[0].startswith('200'):
+            raise Exception("Got %s" % status[0])
+        return size
+
+    def _warm(self, path, md, walk, put):
+        is_dir_path = path.endswith(u'/')
+
+        # files found in a listing come with their metadata,
+        # listing a folder is the only way to get its hash
+        if md is None:
+            md = self.get_metadata(path, is_dir_path)
+        if md.get('is_deleted'):
+            raise Exception("Not found")
+
+        if md['is_dir']:
+            if not is_dir_path:
+                # look at it again as a listing
+                return self._warm(path + u'/', None, walk, put)
+            if walk:
+                for entry in md['contents']:
+                    if entry['is_dir']:
+                        put((entry['path'] + u'/', None))
+                    else:
+                        put((entry['path'], entry))
+            if not self.listings:
+                return
+            etag = '"d%s"' % md['hash']
+        else:
+            etag = '"_%s"' % md['rev']
+
+        if self._is_current(path, etag):
+            logger.debug("Up to date: %r", path)
+            self._count(skipped=1)
+            return
+
+        size = self._fetch(path)
+        logger.info("Warmed %r (%d bytes)", path, size)
+        self._count(files=1, bytes=size)
+
+    def run(self, paths, walk=False):
+        """
+        Warms `paths`, and everything below them if `walk` is true.
+        Returns once they are all done.
+        """
+        # walking workers add to the queue themselves,
+        # so only a replayed log can be bounded
+        q = Queue.Queue(0 if walk else self.threads * 4)
+
+        def worker():
+            while True:
+                item = q.get()
+                try:
+                    if item is None:
+                        return
+                    (path, md) = item
+                    self._warm(path, md, walk, q.put)
+                except Exception, e:
+                    logger.warning("Couldn't warm %r: %s", path, e)
+                    self._count(failed=1)
+                finally:
+                    q.task_done()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for path in paths:
+            q.put((path, None))
+        q.join()
+
+        for t in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+def warm_options():
+    return server_options() + [
+        ('warm_root', 'Warm', None, 'root', identity, '/',
+         'Dropbox folder to walk and cache everything under, e.g. "/photos"'),
+        ('warm_access_log', 'Warm', None, 'access-log', identity, None,
+         ('access log (common or combined format) to replay the successful '
+          'requests of, instead of walking a folder')),
+        ('warm_threads', 'Warm', 'j', 'threads', int, 8,
+         'number of files to download at once'),
+        ('warm_rate', 'Warm', None, 'rate', float, 10,
+         'maximum number of Dropbox API requests per second, 0 means no limit'),
+        ('warm_listings', 'Warm', None, 'listings', bool_from_string, True,
+         'true if you want to cache directory listings too, false otherwise'),
+        ]
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    description = "Fill the dropboxwsgi cache ahead of traffic."
+    options = warm_options()
+
+    try:
+        config = config_from_options(options, argv, description=description)
+    except SystemExit, e:
+        return 2
+
+    logging.basicConfig(level=config['log_level'])
+
+    if not config['enable_local_caching']:
+        usage(options, err="Local caching is disabled, nothing to warm!",
+              argv=argv, description=description)
+        return 3
+
+    cache = cache_from_config(config)
+    app = make_app(config, FileSystemCredStorage(config['app_dir']),
+                   backend=backend_from_config(config))
+    get_metadata = app.get_metadata
+    pool = app.client_pool
+    app = make_caching(cache)(app)
+
+    warmer = Warmer(app, cache, get_metadata,
+                    threads=config['warm_threads'],
+                    rate=config['warm_rate'],
+                    listings=(config['warm_listings'] and
+                              config['allow_directory_listing']),
+                    pool=pool)
+
+    start = time.time()
+    if config['warm_access_log']:
+        with open(config['warm_access_log'], 'r') as f:
+            warmer.run(paths_from_access_log(f))
+    else:
+        root = config['warm_root']
+        if isinstance(root, bytes):
+            root = root.decode('utf8')
+        if not root.startswith(u'/'):
+            root = u'/' + root
+        warmer.run([root.rstrip(u'/') + u'/'], walk=True)
+    elapsed = time.time() - start
+
+    console_output("Warmed %d files (%.1f MiB) in %.1fs, %.2f MiB/s; "
+                   "%d already up to date, %d failed",
+                   warmer.files, warmer.bytes / float(1024 * 1024), elapsed,
+                   warmer.bytes / float(1024 * 1024) / max(elapsed, 1e-6),
+                   warmer.skipped, warmer.failed)
+
+    return 1 if warmer.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -94,9 +94,12 @@ setup(
     author="Rian Hunter",
     author_email="rian@alum.mit.edu",
     packages=['dropboxwsgi'],
+    # not a console script, it has to run before the package is imported
+    scripts=['bin/dropboxwsgi'],
     entry_points={
         'console_scripts': [
-            'dropboxwsgi = dropboxwsgi.main:main'
+            'dropboxwsgi-warm = dropboxwsgi.warm:main',
+            'dropboxwsgi-migrate-cache = dropboxwsgi.migrate:main',
             ]
         },
     install_requires=['dropbox'],
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# This file is part of dropboxwsgi.
+#
+# Copyright (c) Dropbox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dropboxwsgi.main import config_from_options, server_options, with_defaults
+
+class ConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def config(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        return config_from_options(server_options(), ['dropboxwsgi', '-c', self.path])
+
+    def test_unknown_section_is_ignored(self):
+        # the warmer's options share the server's config file
+        config = with_defaults(self.config("[Server]\n"
+                                           "http_root = http://example.com\n"
+                                           "[Warm]\n"
+                                           "warm_threads = 4\n"))
+        self.assertEqual(config['http_root'], 'http://example.com')
+        self.assertNotIn('warm_threads', config)
+
+    def test_unknown_option_is_ignored(self):
+        config = self.config("[Server]\n"
+                             "no_such_option = 1\n")
+        self.assertNotIn('no_such_option', list(config))
+        self.assertEqual(with_defaults(config)['http_root'], None)
+
+if __name__ == '__main__':
+    unittest.main()